@@ -0,0 +1,217 @@
+# Copyright (c) 2016 Bonnie Schulkin. All Rights Reserved.
+#
+# This file is part of box_charts.
+#
+# box_charts is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# box_charts is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with box_charts. If not, see <http://www.gnu.org/licenses/>.
+
+
+#######################################################################################
+# benchmark the render pipeline over the bundled charts
+#
+# Usage: python benchmarks/bench_corpus.py [-o results.json] [--compare baseline.json]
+#                                          [datafile.txt | directory ...]
+#
+# Times each stage separately for every chart (all the bundled ones by default,
+# plus some synthetic big ones):
+#   parse     parse_text
+#   elements  building the flowables (print_metadata, print_measures/create_table)
+#   build     laying them out and writing the PDF
+# The renderer lays each section out as soon as it's made, so elements and build
+# come from the stage times of a RenderProfile rather than timing the calls.
+# Each stage is the best of REPEAT runs, with the fit cache cleared before each run
+# so every run does the same work. Results can be written as JSON and compared
+# against an earlier run, flagging any stage that got slower than the threshold.
+#######################################################################################
+
+import os, sys
+import argparse
+import json
+import platform
+import time
+from io import BytesIO
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import reportlab
+import chord_chart
+
+REPEAT = 5
+STAGES = ('parse', 'elements', 'build')
+
+# a regression has to be this much slower, and by at least MIN_DELTA seconds,
+# so that timer noise on the tiny charts isn't flagged (a small slowdown on
+# every chart still shows up in the totals)
+DEFAULT_THRESHOLD = 1.25
+MIN_DELTA = 0.02
+TOTAL = 'all charts'
+
+#######################################################################################
+# synthetic charts
+#######################################################################################
+def synthetic_chart(title, section_count, rows_per_section, width, lyric_lines, words_per_cell):
+	lines = ['^' + title, '>synthetic benchmark chart']
+	chords = ['G', 'C Bb', '%', 'D7', 'Am7 D7', ':Em', 'C:', 'F#m7b5 B7']
+	words = ['something', 'from', 'the', 'past', 'buried', 'in', 'a', 'shallow', 'grave']
+	for snum in range(section_count):
+		lines.append('')
+		lines.append('+Section %d~width=%d~lyrics=%d' % (snum + 1, width, lyric_lines))
+		for rnum in range(rows_per_section):
+			lines.append('')
+			lines.append('|'.join(chords[(snum + rnum + c) % len(chords)] for c in range(width)))
+			for lnum in range(lyric_lines):
+				cells = []
+				for c in range(width):
+					start = (snum + rnum + lnum + c) % len(words)
+					cells.append(' '.join(words[(start + w) % len(words)] for w in range(words_per_cell)))
+				lines.append('|'.join(cells))
+	return '\n'.join(lines) + '\n'
+
+def synthetic_charts():
+	return {
+		'synthetic: 200 sections': synthetic_chart('Two Hundred Sections', 200, 2, 4, 1, 2),
+		'synthetic: long lyric rows': synthetic_chart('Long Lyric Rows', 10, 8, 6, 4, 7),
+	}
+
+#######################################################################################
+# measuring
+#######################################################################################
+# just the stage times: counting the stringWidth calls would slow the fitting down
+class StageTimes(chord_chart.RenderProfile):
+
+	def measurer(self):
+		return chord_chart.MEASURER
+
+def time_stages(text):
+	best = {}
+	pages = 0
+	for n in range(REPEAT):
+		chord_chart.cached_fit_font_size.cache_clear()
+		profile = StageTimes()
+		renderer = chord_chart.ChartRenderer(profile=profile)
+		times = {}
+
+		start = time.perf_counter()
+		chart = chord_chart.parse_text(text)
+		times['parse'] = time.perf_counter() - start
+
+		renderer.build(chart, BytesIO())
+		times['elements'] = profile.seconds['elements'] + profile.seconds.get('fit', 0.0)
+		times['build'] = profile.seconds['build']
+		pages = renderer.doc.page
+
+		for stage in STAGES:
+			if stage not in best or times[stage] < best[stage]:
+				best[stage] = times[stage]
+
+	best['total'] = sum(best[stage] for stage in STAGES)
+	best['pages'] = pages
+	return best
+
+def run(filenames, synthetic):
+	charts = {}
+	for filename in filenames:
+		text = chord_chart.read_chart(filename)
+		try:
+			charts[os.path.basename(filename)] = time_stages(text)
+		except Exception as e:
+			print("skipping %s: %s" % (filename, e))
+	if synthetic:
+		for (name, text) in synthetic_charts().items():
+			charts[name] = time_stages(text)
+
+	totals = dict((stage, sum(times[stage] for times in charts.values())) for stage in STAGES + ('total',))
+	totals['pages'] = sum(times['pages'] for times in charts.values())
+
+	return {
+		'meta': {
+			'python': platform.python_version(),
+			'reportlab': reportlab.Version,
+			'renderer': chord_chart.RENDERER_VERSION,
+			'repeat': REPEAT,
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		},
+		'charts': charts,
+		'totals': totals,
+	}
+
+#######################################################################################
+# reporting
+#######################################################################################
+def print_results(results):
+	print("%-40s %10s %10s %10s %10s %5s" % (('chart',) + STAGES + ('total', 'pages')))
+	rows = sorted(results['charts'].items()) + [(TOTAL, results['totals'])]
+	for (name, times) in rows:
+		print("%-40s %9.2fms %9.2fms %9.2fms %9.2fms %5d" % (
+				(name[:40],) + tuple(times[stage] * 1000 for stage in STAGES + ('total',)) + (times['pages'],)))
+
+def compare(results, baseline, threshold):
+	# returns the regressions as (chart, stage, baseline seconds, new seconds)
+	regressions = []
+	rows = sorted(results['charts'].items()) + [(TOTAL, results['totals'])]
+	for (name, times) in rows:
+		if name == TOTAL:
+			# only comparable when both runs timed the same charts
+			if sorted(results['charts']) != sorted(baseline['charts']):
+				continue
+			old_times = baseline['totals']
+		elif name in baseline['charts']:
+			old_times = baseline['charts'][name]
+		else:
+			continue
+		for stage in STAGES + ('total',):
+			old = old_times[stage]
+			new = times[stage]
+			if new > old * threshold and new - old > MIN_DELTA:
+				regressions.append((name, stage, old, new))
+	return regressions
+
+#######################################################################################
+# MAIN
+#######################################################################################
+def main(argv):
+	parser = argparse.ArgumentParser(prog='bench_corpus.py',
+			description='Time each stage of rendering the bundled charts.')
+	parser.add_argument('charts', nargs='*', metavar='chart',
+			help='chart .txt file, or a directory of them (default: the bundled charts)')
+	parser.add_argument('-o', '--output',
+			help='write the results to this JSON file')
+	parser.add_argument('--compare', metavar='BASELINE',
+			help='compare against results saved earlier with --output')
+	parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+			help='slowdown ratio counted as a regression (default %(default)s)')
+	parser.add_argument('--no-synthetic', dest='synthetic', action='store_false',
+			help="don't add the synthetic big charts")
+	args = parser.parse_args(argv)
+
+	filenames = chord_chart.get_chart_files(args.charts or [REPO_DIR])
+	results = run(filenames, args.synthetic)
+	print_results(results)
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		regressions = compare(results, baseline, args.threshold)
+		for (name, stage, old, new) in regressions:
+			print("REGRESSION: %s %s %.2fms -> %.2fms (%.2fx)" % (name, stage, old * 1000, new * 1000, new / old))
+		if regressions:
+			sys.exit(1)
+		print("no regressions against " + args.compare)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,325 @@
+# Copyright (c) 2016 Bonnie Schulkin. All Rights Reserved.
+#
+# This file is part of box_charts.
+#
+# box_charts is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# box_charts is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with box_charts. If not, see <http://www.gnu.org/licenses/>.
+
+
+#######################################################################################
+# check the canvas engine against platypus, and the SVG preview against the
+# canvas engine, and time them all
+#
+# Usage: python benchmarks/bench_engines.py [datafile.txt | directory ...]
+#
+# Renders each chart (all the bundled ones by default, plus the synthetic big
+# ones from bench_corpus) with both engines, reads back what each PDF draws on
+# each page (text with its position and size, shaded rectangles, lines) and
+# reports any difference, then does the same for a songbook of them all with a
+# table of contents. The SVG previews are read back the same way and checked
+# against the canvas engine's PDFs. Then it times the two engines from parsed
+# chart to PDF, and the previews from parsed chart to SVG or HTML.
+#######################################################################################
+
+import os, sys
+import re
+import time
+import zlib
+import xml.etree.ElementTree as ET
+from base64 import a85decode
+from io import BytesIO
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import chord_chart
+import bench_corpus
+import chart_preview
+
+REPEAT = 5
+TOLERANCE = 0.01 # points
+SVG = '{http://www.w3.org/2000/svg}'
+
+#######################################################################################
+# reading PDFs back
+#######################################################################################
+STRING_ESCAPE = re.compile(rb'\\([0-7]{1,3}|.)', re.S)
+STRING_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+TOKEN = re.compile(rb'\((?:\\.|[^\\)])*\)|/[^\s/\[\]()<>]+|[-+]?(?:\d+\.?\d*|\.\d+)|[A-Za-z*\']+')
+
+def page_streams(pdf):
+	# the content streams, which reportlab writes out page by page
+	streams = []
+	for match in re.finditer(rb'stream\r?\n(.*?)endstream', pdf, re.S):
+		data = match.group(1).strip()
+		if data.endswith(b'~>'):
+			data = a85decode(data, adobe=True)
+		streams.append(zlib.decompress(data))
+	return streams
+
+def pdf_string(token):
+	# a (string) token's text: the escapes taken out, in the standard fonts' WinAnsi
+	def unescape(match):
+		code = match.group(1)
+		if code[:1].isdigit():
+			return bytes([int(code, 8) & 0xff])
+		return STRING_ESCAPES.get(code, code)
+	return STRING_ESCAPE.sub(unescape, token[1:-1]).decode('cp1252', 'replace')
+
+def multiply(m1, m2):
+	(a, b, c, d, e, f) = m1
+	(a2, b2, c2, d2, e2, f2) = m2
+	return (a*a2 + b*c2, a*b2 + b*d2, c*a2 + d*c2, c*b2 + d*d2, e*a2 + f*c2 + e2, e*b2 + f*d2 + f2)
+
+def apply(m, x, y):
+	return (m[0]*x + m[2]*y + m[4], m[1]*x + m[3]*y + m[5])
+
+def page_items(stream):
+	# (texts, rects, lines) drawn by one content stream, in page coordinates
+	identity = (1, 0, 0, 1, 0, 0)
+	ctm = identity
+	stack = []
+	texts = []
+	rects = []
+	lines = []
+	path = []
+	line_width = 1
+	line_cap = 0
+	fill = (0.0, 0.0, 0.0)
+	font_size = 0
+	leading = 0
+	text_matrix = line_matrix = identity
+	args = []
+
+	for token in TOKEN.findall(stream):
+		if token[:1] in b'(/' or token[:1] in b'+-.0123456789':
+			args.append(token)
+			continue
+		op = token
+		nums = [float(arg) for arg in args if arg[:1] not in b'(/']
+		if op == b'q':
+			stack.append((ctm, line_width, line_cap, fill))
+		elif op == b'Q':
+			(ctm, line_width, line_cap, fill) = stack.pop()
+		elif op == b'cm':
+			ctm = multiply(tuple(nums), ctm)
+		elif op == b'BT':
+			text_matrix = line_matrix = identity
+		elif op == b'Tm':
+			text_matrix = line_matrix = tuple(nums)
+		elif op == b'Td':
+			line_matrix = text_matrix = multiply((1, 0, 0, 1, nums[0], nums[1]), line_matrix)
+		elif op == b'T*':
+			line_matrix = text_matrix = multiply((1, 0, 0, 1, 0, -leading), line_matrix)
+		elif op == b'TL':
+			leading = nums[0]
+		elif op == b'Tf':
+			font_size = nums[0]
+		elif op == b'Tj':
+			(x, y) = apply(multiply(text_matrix, ctm), 0, 0)
+			texts.append((pdf_string(args[0]), font_size, x, y))
+		elif op == b'rg':
+			fill = tuple(nums)
+		elif op == b'w':
+			line_width = nums[0]
+		elif op == b'J':
+			line_cap = int(nums[0])
+		elif op == b'n':
+			path = []
+		elif op == b'm' or op == b'l':
+			path.append(apply(ctm, nums[0], nums[1]))
+		elif op == b're':
+			(x, y, w, h) = nums
+			(x1, y1) = apply(ctm, x, y)
+			(x2, y2) = apply(ctm, x + w, y + h)
+			path.append(fill + (min(x1, x2), min(y1, y2), abs(x2 - x1), abs(y2 - y1)))
+		elif op in (b'f', b'f*'):
+			rects.extend(path)
+			path = []
+		elif op == b'S':
+			for ((x1, y1), (x2, y2)) in zip(path, path[1:]):
+				lines.append((line_width, line_cap) + tuple(min((x1, y1), (x2, y2))) + tuple(max((x1, y1), (x2, y2))))
+			path = []
+		args = []
+
+	return (sorted(texts), sorted(rects), sorted(lines))
+
+def pdf_pages(pdf):
+	return [page_items(stream) for stream in page_streams(pdf)]
+
+#######################################################################################
+# reading SVG previews back
+#######################################################################################
+def svg_number(element, name):
+	return float(element.get(name))
+
+def svg_pages(svg):
+	# (texts, rects, lines) for each page of an SVG preview, turned into
+	# page coordinates as page_items gives them
+	pages = []
+	for page in ET.fromstring(svg).findall(SVG + 'svg'):
+		height = svg_number(page, 'height')
+		texts = []
+		rects = []
+		lines = []
+		# the first is the white page itself
+		for rect in page.findall(SVG + 'rect')[1:]:
+			color = rect.get('fill')
+			fill = tuple(int(color[n:n + 2], 16) / 255.0 for n in (1, 3, 5))
+			(x, y, w, h) = [svg_number(rect, name) for name in ('x', 'y', 'width', 'height')]
+			rects.append(fill + (x, height - y - h, w, h))
+		for group in page.findall(SVG + 'g'):
+			if group.get('font-size') is not None:
+				font_size = svg_number(group, 'font-size')
+				for text in group:
+					texts.append((text.text, font_size, svg_number(text, 'x'), height - svg_number(text, 'y')))
+			else:
+				line_width = svg_number(group, 'stroke-width')
+				line_cap = chart_preview.LINE_CAPS.index(group.get('stroke-linecap'))
+				for line in group:
+					(x1, y1, x2, y2) = [svg_number(line, name) for name in ('x1', 'y1', 'x2', 'y2')]
+					ends = ((x1, height - y1), (x2, height - y2))
+					lines.append((line_width, line_cap) + min(ends) + max(ends))
+		pages.append((sorted(texts), sorted(rects), sorted(lines)))
+	return pages
+
+#######################################################################################
+# comparing
+#######################################################################################
+def differences(items1, items2):
+	# the items in one list and not the other, numbers compared to TOLERANCE
+	def same(a, b):
+		for (v1, v2) in zip(a, b):
+			if isinstance(v1, float) or isinstance(v2, float):
+				if abs(v1 - v2) > TOLERANCE:
+					return False
+			elif v1 != v2:
+				return False
+		return True
+
+	unmatched = list(items2)
+	missing = []
+	for item in items1:
+		for (n, other) in enumerate(unmatched):
+			if same(item, other):
+				del unmatched[n]
+				break
+		else:
+			missing.append(item)
+	return (missing, unmatched)
+
+def compare_pages(pages1, pages2, names=('platypus', 'canvas')):
+	problems = []
+	if len(pages1) != len(pages2):
+		problems.append("%d pages vs %d" % (len(pages1), len(pages2)))
+	for (pnum, (page1, page2)) in enumerate(zip(pages1, pages2)):
+		for (kind, items1, items2) in zip(('text', 'rect', 'line'), page1, page2):
+			(missing, extra) = differences(items1, items2)
+			for item in missing:
+				problems.append("page %d: %s only %s %r" % (pnum + 1, names[0], kind, item))
+			for item in extra:
+				problems.append("page %d: %s only %s %r" % (pnum + 1, names[1], kind, item))
+	return problems
+
+def compare_pdfs(pdf1, pdf2):
+	return compare_pages(pdf_pages(pdf1), pdf_pages(pdf2))
+
+def compare_preview(pdf, svg):
+	return compare_pages(pdf_pages(pdf), svg_pages(svg), ('canvas', 'svg'))
+
+#######################################################################################
+# measuring
+#######################################################################################
+def render(engine, chart):
+	pdf = BytesIO()
+	engine().build(chart, pdf)
+	return pdf.getvalue()
+
+def render_songbook(engine, charts):
+	pdf = BytesIO()
+	engine().render_songbook(charts, pdf, contents=True)
+	return pdf.getvalue()
+
+def time_engine(engine, charts):
+	best = None
+	for n in range(REPEAT):
+		chord_chart.cached_fit_font_size.cache_clear()
+		start = time.perf_counter()
+		for chart in charts:
+			render(engine, chart)
+		seconds = time.perf_counter() - start
+		if best is None or seconds < best:
+			best = seconds
+	return best
+
+#######################################################################################
+# MAIN
+#######################################################################################
+def main(args):
+	charts = {}
+	for filename in chord_chart.get_chart_files(args or [REPO_DIR]):
+		try:
+			charts[os.path.basename(filename)] = chord_chart.parse_text(chord_chart.read_chart(filename))
+		except Exception as e:
+			print("skipping %s: %s" % (filename, e))
+	if not args:
+		for (name, text) in bench_corpus.synthetic_charts().items():
+			charts[name] = chord_chart.parse_text(text)
+
+	failures = 0
+	preview_failures = 0
+	for (name, chart) in sorted(charts.items()):
+		try:
+			canvas_pdf = render(chord_chart.CanvasRenderer, chart)
+			problems = compare_pdfs(render(chord_chart.ChartRenderer, chart), canvas_pdf)
+			preview_problems = compare_preview(canvas_pdf, render(chart_preview.SvgRenderer, chart))
+		except Exception as e:
+			problems = preview_problems = [type(e).__name__ + ": " + str(e)]
+		for (label, found) in (('DIFFERENT', problems), ('DIFFERENT PREVIEW', preview_problems)):
+			if found:
+				print("%s: %s" % (label, name))
+				for problem in found[:10]:
+					print("  " + problem)
+		failures += bool(problems)
+		preview_failures += bool(preview_problems)
+	print("%d of %d charts draw the same with both engines" % (len(charts) - failures, len(charts)))
+	print("%d of %d SVG previews draw what the canvas engine's PDF does" % (len(charts) - preview_failures, len(charts)))
+
+	songbook = [chart for (name, chart) in sorted(charts.items())]
+	canvas_pdf = render_songbook(chord_chart.CanvasRenderer, songbook)
+	for (what, problems) in (
+			('with both engines', compare_pdfs(render_songbook(chord_chart.ChartRenderer, songbook), canvas_pdf)),
+			('as an SVG preview', compare_preview(canvas_pdf, render_songbook(chart_preview.SvgRenderer, songbook)))):
+		if problems:
+			failures += 1
+			print("DIFFERENT: songbook %s" % what)
+			for problem in problems[:10]:
+				print("  " + problem)
+		else:
+			print("the songbook draws the same %s" % what)
+
+	renderable = [chart for chart in charts.values()]
+	results = {}
+	renderers = list(chord_chart.ENGINES.items()) + list(chart_preview.PREVIEWS.items())
+	for (name, engine) in renderers:
+		results[name] = time_engine(engine, renderable)
+		print("  %-10s %9.2fms for %d charts" % (name, results[name] * 1000, len(renderable)))
+	print("  speedup: %.2fx canvas, %.2fx svg, %.2fx html" % tuple(results['platypus'] / results[name] for name in ('canvas', 'svg', 'html')))
+
+	failures += preview_failures
+
+	if failures:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
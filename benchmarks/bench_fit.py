@@ -0,0 +1,175 @@
+# Copyright (c) 2016 Bonnie Schulkin. All Rights Reserved.
+#
+# This file is part of box_charts.
+#
+# box_charts is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# box_charts is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with box_charts. If not, see <http://www.gnu.org/licenses/>.
+
+
+#######################################################################################
+# micro-benchmark for the font fitting done by create_paragraph
+#
+# Usage: python benchmarks/bench_fit.py [datafile.txt | directory ...]
+#
+# Renders the charts (all the bundled ones by default) once to collect every cell
+# that gets fitted, then times the old one-step-at-a-time shrink loop against
+# fit_font_size on those cells, measuring with reportlab's stringWidth and
+# simpleSplit and then with the FontMetrics tables, and checks that they all
+# pick the same sizes as the shrink loop does with reportlab's measurements.
+#######################################################################################
+
+import os, sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import chord_chart
+import chart_renderer
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.lib.utils import simpleSplit
+
+REPEAT = 5
+
+#######################################################################################
+# the shrink loop create_paragraph used to run, measuring with reportlab
+#######################################################################################
+# for fit_font_size to measure with instead of the FontMetrics tables
+class ReportlabMeasurer(chart_renderer.TextMeasurer):
+
+	def text_width(self, text, fontstyle, fontsize):
+		return stringWidth(text, fontstyle, fontsize)
+
+	def line_count(self, text, fontstyle, fontsize, maxwidth):
+		return len(simpleSplit(text, fontstyle, fontsize, maxwidth))
+
+REPORTLAB = ReportlabMeasurer()
+
+def linear_fit(text, fontstyle, fontsize, maxwidth, step, measurer=REPORTLAB):
+	text_width = measurer.text_width(text, fontstyle, fontsize)
+	new_fontsize = fontsize
+	line_count = measurer.line_count(text, fontstyle, new_fontsize, maxwidth)
+
+	while (line_count > 1 or text_width > maxwidth) and new_fontsize > 0:
+		new_fontsize = new_fontsize - step
+		text_width = measurer.text_width(text, fontstyle, new_fontsize)
+		line_count = measurer.line_count(text, fontstyle, new_fontsize, maxwidth)
+
+	return new_fontsize
+
+#######################################################################################
+# measuring
+#######################################################################################
+def collect_cells(filenames):
+	# every (text, font, size, width, step) that create_paragraph fits
+	cells = []
+	fit = chart_renderer.cached_fit_font_size
+
+	def record(*args):
+		# the cell, without the renderer's measurer
+		cells.append(args[:5])
+		return fit(*args)
+	record.cache_info = fit.cache_info
+
+	pdf_dir = chord_chart.PDF_DIR
+	chart_renderer.cached_fit_font_size = record
+	try:
+		with tempfile.TemporaryDirectory() as tmp:
+			chord_chart.PDF_DIR = tmp
+			for filename in filenames:
+				error = chord_chart.render_job(filename).error
+				if error:
+					print("skipping " + filename + ": " + error)
+	finally:
+		chart_renderer.cached_fit_font_size = fit
+		chord_chart.PDF_DIR = pdf_dir
+
+	return cells
+
+# measures with another measurer, counting the measurements
+class CountingMeasurer(chart_renderer.TextMeasurer):
+
+	def __init__(self, measurer):
+		self.measurer = measurer
+		self.calls = 0
+
+	def text_width(self, text, fontstyle, fontsize):
+		self.calls += 1
+		return self.measurer.text_width(text, fontstyle, fontsize)
+
+	def line_count(self, text, fontstyle, fontsize, maxwidth):
+		self.calls += 1
+		return self.measurer.line_count(text, fontstyle, fontsize, maxwidth)
+
+def count_measurements(fit, cells, measurer):
+	# width + line count measurements per cell
+	counts = []
+	counting = CountingMeasurer(measurer)
+	for cell in cells:
+		counting.calls = 0
+		fit(*cell, measurer=counting)
+		counts.append(counting.calls)
+	return counts
+
+def time_fit(fit, cells, measurer):
+	best = None
+	for n in range(REPEAT):
+		# the glyph tables and string widths are built afresh, as for a new batch
+		chart_renderer.font_metrics_cache.clear()
+		start = time.perf_counter()
+		for cell in cells:
+			fit(*cell, measurer=measurer)
+		seconds = time.perf_counter() - start
+		if best is None or seconds < best:
+			best = seconds
+	return best
+
+#######################################################################################
+# MAIN
+#######################################################################################
+def main(args):
+	filenames = chord_chart.get_chart_files(args or [REPO_DIR])
+	cells = collect_cells(filenames)
+	print("%d cells from %d charts" % (len(cells), len(filenames)))
+
+	expected = [linear_fit(*cell) for cell in cells]
+	searched = [chart_renderer.fit_font_size(*cell, measurer=REPORTLAB) for cell in cells]
+	fitted = [chart_renderer.fit_font_size(*cell) for cell in cells]
+	mismatches = [cell for (cell, size, size2, size3) in zip(cells, expected, searched, fitted) if not size == size2 == size3]
+	for cell in mismatches:
+		print("MISMATCH: %r" % (cell,))
+
+	# most cells fit at full size; the ones that have to shrink are where it counts
+	shrunk = [cell for (cell, size) in zip(cells, expected) if size != cell[2]]
+	for (label, these_cells) in (('all cells', cells), ('shrunk cells', shrunk)):
+		if not these_cells:
+			continue
+		print("\n%s (%d)" % (label, len(these_cells)))
+		results = {}
+		for (name, fit, measurer) in (('linear', linear_fit, REPORTLAB), ('search', chart_renderer.fit_font_size, REPORTLAB),
+				('fit_font_size', chart_renderer.fit_font_size, chart_renderer.MEASURER)):
+			counts = count_measurements(fit, these_cells, measurer)
+			seconds = time_fit(fit, these_cells, measurer)
+			results[name] = seconds
+			print("  %-14s %8.2fms  %6.2fus/cell  measurements/cell: mean %.2f max %d" % (
+					name, seconds * 1000, seconds * 1e6 / len(these_cells),
+					sum(counts) / len(counts), max(counts)))
+		print("  speedup: %.2fx over linear, %.2fx over search" % (
+				results['linear'] / results['fit_font_size'], results['search'] / results['fit_font_size']))
+
+	if mismatches:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,224 @@
+# Copyright (c) 2016 Bonnie Schulkin. All Rights Reserved.
+#
+# This file is part of box_charts.
+#
+# box_charts is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# box_charts is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with box_charts. If not, see <http://www.gnu.org/licenses/>.
+
+
+#######################################################################################
+# load test chord_chart.py --serve
+#
+# Usage: python benchmarks/bench_server.py [--url URL] [-j WORKERS] [--queue N]
+#                                          [-c CLIENTS] [-n REQUESTS]
+#                                          [-o results.json] [--compare baseline.json]
+#                                          [datafile.txt | directory ...]
+#
+# Starts a server on a free port on localhost (or uses the one at --url) and posts the
+# charts to it (all the bundled ones by default, round-robin) from CLIENTS threads at
+# once, each keeping its connection open, until REQUESTS charts have been sent.
+# Reports the throughput in charts rendered per second and the latency percentiles of
+# the rendered ones; 503s (the server's queue was full) and anything else that wasn't
+# a PDF are counted separately. Results can be saved and compared like
+# bench_corpus's: lower throughput or a higher p99 by more than the threshold is a
+# regression.
+#######################################################################################
+
+import os, sys
+import argparse
+import http.client
+import itertools
+import json
+import platform
+import subprocess
+import threading
+import time
+from math import ceil
+from urllib.parse import urlsplit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+SCRIPT = os.path.join(REPO_DIR, 'chord_chart.py')
+
+import chord_chart
+
+DEFAULT_REQUESTS = 400
+PERCENTILES = (50, 90, 99)
+DEFAULT_THRESHOLD = 1.25
+MIN_DELTA = 0.005 # seconds of p99, so that timer noise isn't flagged
+
+#######################################################################################
+# server
+#######################################################################################
+def start_server(workers, queue, engine):
+	# a server on a free port; returns (process, url) once it's taking requests
+	args = [sys.executable, SCRIPT, '--serve', '127.0.0.1:0', '--jobs', str(workers), '--engine', engine]
+	if queue is not None:
+		args += ['--queue', str(queue)]
+	server = subprocess.Popen(args, stdout=subprocess.PIPE, text=True)
+	line = server.stdout.readline()
+	if not line.startswith('serving'):
+		server.kill()
+		raise RuntimeError("the server didn't start: " + line)
+	return (server, line.split()[3])
+
+#######################################################################################
+# measuring
+#######################################################################################
+def client(url, bodies, numbers, requests, results):
+	# posts charts until REQUESTS have been sent between all the clients,
+	# appending (status, seconds) for each; status is None if the connection failed
+	url = urlsplit(url)
+	connection = None
+	for n in numbers:
+		if n >= requests:
+			break
+		if connection is None:
+			connection = http.client.HTTPConnection(url.hostname, url.port)
+		start = time.perf_counter()
+		try:
+			connection.request('POST', url.path or '/', bodies[n % len(bodies)])
+			response = connection.getresponse()
+			response.read()
+			status = response.status
+		except (OSError, http.client.HTTPException):
+			connection.close()
+			connection = None
+			status = None
+		results.append((status, time.perf_counter() - start))
+	if connection is not None:
+		connection.close()
+
+def percentile(seconds, p):
+	# nearest rank, of sorted seconds
+	if not seconds:
+		return 0.0
+	return seconds[max(0, int(ceil(p / 100.0 * len(seconds))) - 1)]
+
+def run(url, bodies, clients, requests):
+	results = []
+	numbers = itertools.count()
+	threads = [threading.Thread(target=client, args=(url, bodies, numbers, requests, results))
+			for n in range(clients)]
+	start = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	wall = time.perf_counter() - start
+
+	seconds = sorted(s for (status, s) in results if status == 200)
+	stats = {
+		'requests': len(results),
+		'rendered': len(seconds),
+		'busy': sum(1 for (status, s) in results if status == 503),
+		'failed': sum(1 for (status, s) in results if status not in (200, 503)),
+		'wall': wall,
+		'throughput': len(seconds) / wall,
+		'max': seconds[-1] if seconds else 0.0,
+	}
+	for p in PERCENTILES:
+		stats['p%d' % p] = percentile(seconds, p)
+	return stats
+
+#######################################################################################
+# MAIN
+#######################################################################################
+def main(argv):
+	parser = argparse.ArgumentParser(prog='bench_server.py',
+			description='Load test the chart server.')
+	parser.add_argument('charts', nargs='*', metavar='chart',
+			help='chart .txt file, or a directory of them (default: the bundled charts)')
+	parser.add_argument('--url',
+			help='post to the server already running here instead of starting one')
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+			help="the started server's worker processes (default %(default)s)")
+	parser.add_argument('--queue', type=int,
+			help="the started server's --queue")
+	parser.add_argument('--engine', choices=chord_chart.ENGINE_NAMES, default='platypus',
+			help="the started server's --engine (default %(default)s)")
+	parser.add_argument('-c', '--clients', type=int,
+			help='requests sent at once (default twice the workers)')
+	parser.add_argument('-n', '--requests', type=int, default=DEFAULT_REQUESTS,
+			help='charts to post in all (default %(default)s)')
+	parser.add_argument('-o', '--output',
+			help='write the results to this JSON file')
+	parser.add_argument('--compare', metavar='BASELINE',
+			help='compare against results saved earlier with --output')
+	parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+			help='slowdown ratio counted as a regression (default %(default)s)')
+	args = parser.parse_args(argv)
+
+	# only charts that parse, so that every failure is the server's
+	bodies = []
+	for filename in chord_chart.get_chart_files(args.charts or [REPO_DIR]):
+		text = chord_chart.read_chart(filename)
+		try:
+			chord_chart.parse_text(text)
+		except Exception as e:
+			print("skipping %s: %s" % (filename, chord_chart.error_message(e)))
+			continue
+		bodies.append(text.encode('utf-8'))
+	clients = args.clients or 2 * args.jobs
+
+	server = None
+	url = args.url
+	if url is None:
+		(server, url) = start_server(args.jobs, args.queue, args.engine)
+	try:
+		stats = run(url, bodies, clients, args.requests)
+	finally:
+		if server is not None:
+			server.terminate()
+			server.wait()
+
+	print("%d charts from %d clients to %s in %.2fs" % (stats['requests'], clients, url, stats['wall']))
+	print("%d rendered, %d busy (503), %d failed" % (stats['rendered'], stats['busy'], stats['failed']))
+	print("throughput %.1f charts/s" % stats['throughput'])
+	print("latency    " + "  ".join("p%d %.2fms" % (p, stats['p%d' % p] * 1000) for p in PERCENTILES)
+			+ "  max %.2fms" % (stats['max'] * 1000))
+
+	results = {
+		'meta': {
+			'python': platform.python_version(),
+			'renderer': chord_chart.RENDERER_VERSION,
+			'clients': clients,
+			'workers': None if args.url else args.jobs,
+			'engine': None if args.url else args.engine,
+			'charts': len(bodies),
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		},
+		'stats': stats,
+	}
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+
+	problems = []
+	if stats['failed']:
+		problems.append("%d requests failed" % stats['failed'])
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)['stats']
+		if stats['throughput'] * args.threshold < baseline['throughput']:
+			problems.append("REGRESSION: throughput %.1f -> %.1f charts/s" % (baseline['throughput'], stats['throughput']))
+		if stats['p99'] > baseline['p99'] * args.threshold and stats['p99'] - baseline['p99'] > MIN_DELTA:
+			problems.append("REGRESSION: p99 %.2fms -> %.2fms" % (baseline['p99'] * 1000, stats['p99'] * 1000))
+
+	for problem in problems:
+		print(problem)
+	if problems:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
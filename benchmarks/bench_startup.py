@@ -0,0 +1,146 @@
+# Copyright (c) 2016 Bonnie Schulkin. All Rights Reserved.
+#
+# This file is part of box_charts.
+#
+# box_charts is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# box_charts is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with box_charts. If not, see <http://www.gnu.org/licenses/>.
+
+
+#######################################################################################
+# benchmark startup: what running chord_chart.py costs before any real work
+#
+# Usage: python benchmarks/bench_startup.py [-o results.json] [--compare baseline.json]
+#                                           [--budget MS]
+#
+# Times, each in a fresh process (best of REPEAT):
+#   python         the interpreter starting and doing nothing, for scale
+#   import         import chord_chart
+#   help           chord_chart.py --help
+#   parse          importing chord_chart and parsing sample_input.txt
+#   check          chord_chart.py --check sample_input.txt
+#   cold render    chord_chart.py --force sample_input.txt, in an empty directory
+#                  so that no cache of any kind helps
+# and checks that importing, --help, parsing and checking don't import reportlab. Results
+# can be saved and compared like bench_corpus's; --budget fails the run if a cold
+# render takes longer than that.
+#######################################################################################
+
+import os, sys
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SCRIPT = os.path.join(REPO_DIR, 'chord_chart.py')
+SAMPLE = os.path.join(REPO_DIR, 'sample_input.txt')
+
+REPEAT = 7
+DEFAULT_THRESHOLD = 1.25
+MIN_DELTA = 0.01
+
+# prints whether reportlab got imported
+IMPORTED = "; print('reportlab' in sys.modules)"
+
+#######################################################################################
+# measuring
+#######################################################################################
+def commands():
+	# name, then the command line; the cold render runs in a fresh directory
+	python = sys.executable
+	return [
+		('python', [python, '-c', 'pass']),
+		('import', [python, '-c', 'import sys, chord_chart' + IMPORTED]),
+		('help', [python, SCRIPT, '--help']),
+		('parse', [python, '-c', 'import sys, chord_chart; chord_chart.parse_text(chord_chart.read_chart(%r))' % SAMPLE + IMPORTED]),
+		('check', [python, '-c', 'import sys, chord_chart; chord_chart.main(["--check", %r])' % SAMPLE + IMPORTED]),
+		('cold render', [python, SCRIPT, '--force', SAMPLE]),
+	]
+
+def run_once(args):
+	with tempfile.TemporaryDirectory() as tmp:
+		env = dict(os.environ, PYTHONPATH=REPO_DIR)
+		start = time.perf_counter()
+		result = subprocess.run(args, cwd=tmp, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		seconds = time.perf_counter() - start
+	if result.returncode != 0:
+		raise RuntimeError("%s failed: %s" % (' '.join(args), result.stderr.decode()))
+	return (seconds, result.stdout.decode())
+
+def run():
+	times = {}
+	problems = []
+	for (name, args) in commands():
+		best = None
+		for n in range(REPEAT):
+			(seconds, output) = run_once(args)
+			if best is None or seconds < best:
+				best = seconds
+		times[name] = best
+		if output.strip().endswith('True'):
+			problems.append("%s imported reportlab" % name)
+
+	return ({
+		'meta': {
+			'python': platform.python_version(),
+			'repeat': REPEAT,
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		},
+		'times': times,
+	}, problems)
+
+#######################################################################################
+# MAIN
+#######################################################################################
+def main(argv):
+	parser = argparse.ArgumentParser(prog='bench_startup.py',
+			description="Time chord_chart.py's startup.")
+	parser.add_argument('-o', '--output',
+			help='write the results to this JSON file')
+	parser.add_argument('--compare', metavar='BASELINE',
+			help='compare against results saved earlier with --output')
+	parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+			help='slowdown ratio counted as a regression (default %(default)s)')
+	parser.add_argument('--budget', type=float, metavar='MS',
+			help='fail if a cold render of sample_input.txt takes longer than this')
+	args = parser.parse_args(argv)
+
+	(results, problems) = run()
+	for (name, seconds) in results['times'].items():
+		print("%-12s %9.2fms" % (name, seconds * 1000))
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		for (name, new) in results['times'].items():
+			old = baseline['times'].get(name)
+			if old is not None and new > old * args.threshold and new - old > MIN_DELTA:
+				problems.append("REGRESSION: %s %.2fms -> %.2fms (%.2fx)" % (name, old * 1000, new * 1000, new / old))
+
+	cold = results['times']['cold render'] * 1000
+	if args.budget is not None and cold > args.budget:
+		problems.append("cold render took %.2fms, over the %.2fms budget" % (cold, args.budget))
+
+	for problem in problems:
+		print(problem)
+	if problems:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,531 @@
+# Copyright (c) 2016 Bonnie Schulkin. All Rights Reserved.
+#
+# This file is part of box_charts.
+#
+# box_charts is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# box_charts is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with box_charts. If not, see <http://www.gnu.org/licenses/>.
+
+
+#######################################################################################
+# reading and parsing chart text, for chord_chart.py and chart_renderer.py
+#
+# The chart syntax, the parsed chart model and the parse cache, with no reportlab
+# in sight: chord_chart.py parses and checks charts with it alone, and
+# chart_renderer.py renders what it parses.
+#######################################################################################
+
+#######################################################################################
+# imports
+#######################################################################################
+
+import os
+import hashlib
+from math import isfinite
+import marshal
+from collections import OrderedDict
+
+#######################################################################################
+# constants
+#######################################################################################
+SECTION_START = '+'
+MEASURE_SPLIT = '|'
+SECTION_LINE_SPLIT = '~'
+TITLE_START = '^'
+METADATA_START = '>'
+REPEAT_CHAR = ':'
+SCALE_START = '*'
+KEY_CHANGE_START = '}'
+KEY_CHANGE_SPLIT = '~'
+
+DEBUG = False
+
+PDF_DIR = 'pdf' # where the PDFs are written, unless told otherwise
+MAX_SCALE = 1000 # nothing fits on a page long before this, and much more overflows the font sizes
+PARSE_CACHE_DIR = os.path.join('box_charts', 'parse') # under the user's cache directory
+PARSE_CACHE_SIZE = 256 # parsed charts kept in memory
+
+# part of every parse cache key; bump it whenever the parser or the chart model
+# changes what a cached chart would hold, or which charts parse at all
+CHART_FORMAT_VERSION = 5
+
+SCALE_DEGREES = {}
+SCALE_DEGREES['Ab'] = ['Ab', 'Bb', 'C', 'Db', 'Eb', 'F', 'G']
+SCALE_DEGREES['A'] = ['A', 'B', 'C#', 'D', 'E', 'F#', 'G#']
+SCALE_DEGREES['Bb'] = ['Bb', 'C', 'D', 'Eb', 'F', 'G', 'A']
+SCALE_DEGREES['B'] = ['B', 'C#', 'D#', 'E', 'F#', 'G#', 'A#']
+SCALE_DEGREES['C'] = ['C', 'D', 'E', 'F', 'G', 'A', 'B']
+SCALE_DEGREES['Db'] = ['Db', 'Eb', 'F', 'Gb', 'Ab', 'Bb', 'C']
+SCALE_DEGREES['D'] = ['D', 'E', 'F#', 'G', 'A', 'B', 'C#']
+SCALE_DEGREES['Eb'] = ['Eb', 'F', 'G', 'Ab', 'Bb', 'C', 'D']
+SCALE_DEGREES['E'] = ['E', 'F#', 'G#', 'A', 'B', 'C#', 'D#']
+SCALE_DEGREES['F'] = ['F', 'G', 'A', 'Bb', 'C', 'D', 'E']
+SCALE_DEGREES['F#'] = ['F#', 'G#', 'A#', 'B', 'C#', 'D#', 'E#']
+SCALE_DEGREES['G'] = ['G', 'A', 'B', 'C', 'D', 'E', 'F#']
+
+#######################################################################################
+# errors
+#######################################################################################
+
+# bad chart data: the chart can't be rendered, but a batch run can carry on
+class ChartError(Exception):
+
+	def __init__(self, message, line=None):
+		Exception.__init__(self, message)
+		self.line = line # the chart line it's about, counting from 1, if there is one
+
+def error_message(e):
+	# what to report for an exception from parsing or rendering a chart
+	if isinstance(e, ChartError):
+		return str(e) if e.line is None else "line %d: %s" % (e.line, e)
+	return type(e).__name__ + ": " + str(e)
+
+#######################################################################################
+# functions  
+#######################################################################################
+
+def print_debug(string):
+	if DEBUG:
+		print(string)
+
+def read_chart(filename):
+	# relative to the current directory, or failing that to the script's
+	if not os.path.exists(filename):
+		scriptDir = os.path.dirname(os.path.realpath(__file__))
+		filename = os.path.join(scriptDir, filename)
+	with open(filename) as f:
+		return f.read()
+
+def get_list(filename): 
+	return read_chart(filename).split('\n')
+
+def measure_split(line, chords):
+	l = line
+	if chords:
+		l = line.strip(MEASURE_SPLIT)
+	return l.split(MEASURE_SPLIT)
+
+def initialize_rows(rowcount):
+	r = {}
+	for rownum in range(rowcount):
+		r[rownum] = []
+	return r
+
+def lyric_occupancy(lyric_array):
+	# for each lyric line, a byte per measure saying whether it has lyrics, so
+	# a section's lyrics are looked at once however many rows it's split into
+	return [bytes(map(bool, lyric_row)) for lyric_row in lyric_array]
+
+def count_lyric_lines(occupancy, measure_start, column_count):
+	# do we need to print all the lyrics rows? Up to the last line with
+	# lyrics anywhere in the window
+	if column_count <= 0:
+		return 0
+	measure_end = measure_start + column_count
+	for lyric_line in range(len(occupancy), 0, -1):
+		if occupancy[lyric_line - 1].find(1, measure_start, measure_end) >= 0:
+			return lyric_line
+
+	# if we got this far, no lines are good
+	return 0
+
+def get_lyric_lines(lyric_array, measure_start, column_count):
+	return count_lyric_lines(lyric_occupancy(lyric_array), measure_start, column_count)
+
+#######################################################################################
+# transpose
+#######################################################################################
+def make_transpose_table(key1, key2):
+	# chord root as written in key1 -> the same scale degree in key2. Naturals
+	# that aren't in key1 are a semitone off one of its notes, and keep that
+	# accidental (C in the key of A is C# flattened, so it becomes a flat degree)
+	scale1 = SCALE_DEGREES[key1]
+	scale2 = SCALE_DEGREES[key2]
+
+	table = {}
+	for index in range(len(scale1)):
+		table[scale1[index]] = scale2[index]
+	for index in range(len(scale1)):
+		natural = scale1[index][0]
+		if natural not in table:
+			if scale1[index][1:] == '#':
+				table[natural] = scale2[index] + 'b'
+			else:
+				table[natural] = scale2[index] + '#'
+	return table
+
+# every key to every other key, worked out once
+TRANSPOSE_TABLES = dict(((key1, key2), make_transpose_table(key1, key2))
+		for key1 in SCALE_DEGREES for key2 in SCALE_DEGREES)
+
+def transpose(key1, key2, raw_chord):
+	if (key1, key2) not in TRANSPOSE_TABLES:
+		raise ChartError("unknown key change: [" + key1 + KEY_CHANGE_SPLIT + key2 + "]")
+	table = TRANSPOSE_TABLES[(key1, key2)]
+		
+	before_stuff = ''
+	after_stuff = ''
+	chord = raw_chord
+	if chord[0:1] == REPEAT_CHAR:
+		before_stuff = REPEAT_CHAR
+		chord = chord[1:]
+	if chord[-1:] == REPEAT_CHAR:
+		after_stuff = REPEAT_CHAR
+		chord = chord[:-1]
+
+	if chord in ['%', '']:
+		return(raw_chord)
+	
+	# find the root
+	if chord[0:2] in table:
+		root = chord[0:2]
+	elif chord[0:1] in table:
+		root = chord[0:1]
+	else:
+		raise ChartError("bad chord: [" + chord + "]")
+	
+	# translate it to the new key
+	new_chord = before_stuff + table[root] + chord[len(root):] + after_stuff
+	
+	# eliminate nonsense like b# or #b
+	new_chord = new_chord.replace('b#', '')
+	new_chord = new_chord.replace('#b', '')
+	
+	return new_chord
+
+def transpose_list(key1, key2, old_chords):
+	if key1 == '':
+		return old_chords
+		
+	new_chords = []
+	for raw_chord in old_chords:
+		if ' ' in raw_chord:
+			new_chord = ' '.join(transpose_list(key1, key2, raw_chord.split(' ')))
+		elif '/' in raw_chord:
+			new_chord = '/'.join(transpose_list(key1, key2, raw_chord.split('/')))			
+		else:
+			new_chord = transpose(key1, key2, raw_chord)
+		
+		new_chords.append(new_chord)
+		
+	return new_chords
+
+#######################################################################################
+# chart model
+#######################################################################################
+
+# A parsed chart. Sections hold the measures in order: chords[i] is the chord
+# text of measure i, and lyrics[n][i] the lyrics under it on lyric line n + 1
+# (lyric lines may stop short of the last measure).
+class Chart:
+	__slots__ = ('title', 'other', 'scale', 'key', 'sections')
+
+	def __init__(self):
+		self.title = None
+		self.other = []
+		self.scale = 1
+		self.key = None # the key the chords are in, if the chart says
+		self.sections = []
+
+class Section:
+	__slots__ = ('name', 'width', 'lcount', 'pickup', 'chords', 'lyrics')
+
+	def __init__(self):
+		self.name = ''
+		self.width = None
+		self.lcount = None
+		self.pickup = None
+		self.chords = []
+		self.lyrics = []
+
+def chart_to_bytes(chart):
+	sections = [(s.name, s.width, s.lcount, s.pickup, s.chords, s.lyrics) for s in chart.sections]
+	return marshal.dumps((CHART_FORMAT_VERSION, chart.title, chart.other, chart.scale, chart.key, sections))
+
+def chart_from_bytes(data):
+	(version, title, other, scale, key, sections) = marshal.loads(data)
+	if version != CHART_FORMAT_VERSION:
+		raise ValueError('chart data is format ' + str(version))
+
+	chart = Chart()
+	chart.title = title
+	chart.other = other
+	chart.scale = scale
+	chart.key = key
+	for (name, width, lcount, pickup, chords, lyrics) in sections:
+		section = Section()
+		section.name = name
+		section.width = width
+		section.lcount = lcount
+		section.pickup = pickup
+		section.chords = chords
+		section.lyrics = lyrics
+		chart.sections.append(section)
+	return chart
+
+def transpose_chart(chart, from_key, to_key):
+	# a copy of the chart with its chords moved from from_key to to_key
+	new_chart = Chart()
+	new_chart.title = chart.title
+	new_chart.other = chart.other
+	new_chart.scale = chart.scale
+	new_chart.key = to_key
+	for section in chart.sections:
+		new_section = Section()
+		new_section.name = section.name
+		new_section.width = section.width
+		new_section.lcount = section.lcount
+		new_section.pickup = section.pickup
+		new_section.chords = transpose_list(from_key, to_key, section.chords)
+		new_section.lyrics = section.lyrics
+		new_chart.sections.append(new_section)
+	return new_chart
+
+def rescale_chart(chart, scale):
+	# a copy of the chart drawn at another scale
+	new_chart = Chart()
+	new_chart.title = chart.title
+	new_chart.other = chart.other
+	new_chart.scale = scale
+	new_chart.key = chart.key
+	new_chart.sections = chart.sections
+	return new_chart
+
+# Parsed charts by hash of their text, so rendering the same chart again skips
+# the parser. The most recent PARSE_CACHE_SIZE are kept in memory; given a
+# directory, their binary form is kept there too and survives between runs.
+class ParseCache:
+
+	def __init__(self, directory=None):
+		self.directory = directory
+		self.charts = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def parse(self, text):
+		key = hashlib.sha1((str(CHART_FORMAT_VERSION) + '\0' + text).encode('utf-8')).hexdigest()
+		if key in self.charts:
+			self.charts.move_to_end(key)
+			self.hits += 1
+			return chart_from_bytes(self.charts[key])
+
+		data = self.load(key)
+		if data is None:
+			self.misses += 1
+			data = chart_to_bytes(parse_text(text))
+			self.save(key, data)
+		else:
+			self.hits += 1
+
+		self.charts[key] = data
+		if len(self.charts) > PARSE_CACHE_SIZE:
+			self.charts.popitem(last=False)
+		return chart_from_bytes(data)
+
+	def load(self, key):
+		if self.directory is None:
+			return None
+		try:
+			with open(os.path.join(self.directory, key), 'rb') as f:
+				data = f.read()
+			chart_from_bytes(data)
+		except (OSError, ValueError, EOFError, TypeError):
+			return None
+		return data
+
+	def save(self, key, data):
+		if self.directory is None:
+			return
+		# a chart that can't be cached is parsed again next time
+		try:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			tmp_path = os.path.join(self.directory, key + '.tmp')
+			with open(tmp_path, 'wb') as f:
+				f.write(data)
+			os.replace(tmp_path, os.path.join(self.directory, key))
+		except OSError:
+			pass
+
+def parse_cache_dir():
+	# where the parsed charts are kept: the user's cache directory, not the PDF directory
+	cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(cache_home, PARSE_CACHE_DIR)
+
+#######################################################################################
+# parse file
+#######################################################################################
+
+def parse_file(data_file):
+	return parse_lines(get_list(data_file))
+
+def parse_text(text):
+	return parse_lines(text.split('\n'))
+
+def parse_stream(stream):
+	# any file-like object giving lines of chart text, as str or bytes
+	return parse_lines(read_lines(stream))
+
+def read_lines(stream):
+	for line in stream:
+		if isinstance(line, bytes):
+			line = line.decode('utf-8')
+		if line.endswith('\n'):
+			line = line[:-1]
+		yield line
+
+def parse_lines(lines, errors=None):
+	# Given a list for errors, a bad line is added to it and skipped instead of
+	# raised, so one pass finds every error. Either way the ChartError says which
+	# line it's about.
+
+	chart = Chart()
+	section = None
+	new_measure = False
+	lyrics_line_next = False
+	lnum = 1
+	first_measure = True
+	from_key = ''
+	to_key = ''
+	width = None
+	lcount = None
+
+	for (line_number, line) in enumerate(lines, 1):
+		try:
+			# new measure line
+			if line == '':
+				new_measure = True
+				lyrics_line_next = False
+		# 		print("blank line: [" + line + "]")
+			
+			# title line
+			elif line[0] == TITLE_START:	
+				chart.title = line[1:]
+
+			#  metadata line
+			elif line[0] == METADATA_START:
+				chart.other.append(line[1:])
+		
+			elif line[0] == SCALE_START:
+				try:
+					scale = float(line[7:])
+				except ValueError:
+					raise ChartError("Bad scale line [" + line + "]")
+				# a scale has to draw something, at a size that can be worked with
+				if not (isfinite(scale) and 0 < scale <= MAX_SCALE):
+					raise ChartError("Bad scale line [" + line + "]")
+				chart.scale = scale
+
+			elif line[0] == KEY_CHANGE_START:
+				keys = line[1:].split(KEY_CHANGE_SPLIT)
+				if len(keys) != 2:
+					raise ChartError("Bad key change line [" + line + "]")
+				if tuple(keys) not in TRANSPOSE_TABLES:
+					raise ChartError("unknown key change: [" + line[1:] + "]")
+				from_key, to_key = keys
+				chart.key = to_key
+
+			# new section
+			elif line[0] == SECTION_START:
+		# 		print("section line: [" + line + "]")
+				section = Section()
+				chart.sections.append(section)
+				new_measure = True
+				first_measure = True
+				lyrics_line_next = False
+
+				tokens = line[1:].split(SECTION_LINE_SPLIT)
+				section.name = tokens[0]
+				if not section.name:
+					print_debug('WARNING: section ' + str(len(chart.sections)) + ' has no name')
+			
+				for item in tokens[1:]:
+					if item.count('=') != 1:
+						raise ChartError("Bad section line [" + line + "]")
+					(key, val) = item.split('=')
+					if key not in ('width', 'lyrics', 'pickup'):
+						raise ChartError("Bad section data: [" + item + "]")
+					try:
+						val = int(val)
+					except ValueError:
+						raise ChartError("Bad section data: [" + item + "]")
+					# a section needs a column to lay out, and can't have fewer than no lyrics
+					if val < 0 or (key == 'width' and val == 0):
+						raise ChartError("Bad section data: [" + item + "]")
+					if key == 'width':
+						width = val
+						section.width = width
+					elif key == 'lyrics':
+						lcount = val
+						section.lcount = lcount
+					else:
+						section.pickup = val
+
+				# every section needs its width; one without lyrics= has as many as the last
+				if section.width is None:
+					raise ChartError("section [" + section.name + "] has no width=")
+				if lcount is None:
+					raise ChartError("section [" + section.name + "] has no lyrics=")
+			
+			# measure line
+			elif new_measure:
+		# 		print("measure first line: [" + line + "]")
+				if section is None:
+					raise ChartError("measures before the first section line: [" + line + "]")
+
+				if first_measure:
+					first_measure = False
+				else:
+				# clean up from previous measure
+					while (lcount or 0) >= lnum:
+						if lnum > len(section.lyrics):
+							section.lyrics.append([])
+						section.lyrics[lnum - 1].extend([''] * (width or 0))
+						lnum += 1
+			
+				raw_chords = measure_split(line, chords=True)
+				if '' in raw_chords:
+					raise ChartError("empty measure in [" + line + "]")
+				new_measure = False
+				lyrics_line_next = True
+				lnum = 1
+				linelength = len(raw_chords)
+				chords = transpose_list(from_key, to_key, raw_chords)
+				section.chords.extend(chords)
+			
+			# lyrics line
+			elif lyrics_line_next:
+		# 		print("lyrics line: [" + line + "]")
+				lyrics = measure_split(line, chords=False)
+				if len(lyrics) > linelength:
+					raise ChartError("lyrics line [" + line + "] has too many measures")
+			
+				while len(lyrics) < linelength:
+					lyrics.append('')
+			
+				if lnum > len(section.lyrics):
+					section.lyrics.append([])
+				section.lyrics[lnum - 1].extend(lyrics)
+				lnum += 1
+			
+			# should never get here
+			else: 
+				raise ChartError("bad line: [" + line + "]")
+
+		except ChartError as e:
+			if e.line is None:
+				e.line = line_number
+			if errors is None:
+				raise
+			errors.append(e)
+
+	return chart
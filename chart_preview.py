@@ -0,0 +1,185 @@
+# Copyright (c) 2016 Bonnie Schulkin. All Rights Reserved.
+#
+# This file is part of box_charts.
+#
+# box_charts is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# box_charts is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with box_charts. If not, see <http://www.gnu.org/licenses/>.
+
+
+#######################################################################################
+# SVG and HTML previews of charts, for chord_chart.py --preview
+#
+# The canvas engine lays each page out as text, shaded rectangles and lines before
+# drawing them onto a PDF canvas; these draw the same pages as SVG instead, so a
+# preview has everything the PDF has (fitted sizes, shading, repeat bars, page
+# breaks) without a PDF being written. The PDF stays the real thing: the previews
+# use whatever fonts the browser has for Helvetica, and don't embed anything.
+#######################################################################################
+
+from collections import OrderedDict
+from functools import lru_cache
+from html import escape
+
+from reportlab.lib.fonts import ps2tt
+
+from chart_renderer import CanvasRenderer
+
+PAGE_GAP = 12 # points between the pages of an SVG preview
+BACKGROUND_COLOR = '#808080' # round the pages of an HTML preview
+
+# what to ask the browser for in place of the PDF's standard fonts
+FONT_FAMILIES = {
+	'helvetica': 'Helvetica, Arial, sans-serif',
+	'times': "Times, 'Times New Roman', serif",
+	'courier': 'Courier, monospace',
+}
+
+LINE_CAPS = ('butt', 'round', 'square') # by canvas.setLineCap number
+
+#######################################################################################
+# svg
+#######################################################################################
+
+@lru_cache(maxsize=None)
+def font_attributes(fontname):
+	try:
+		(family, bold, italic) = ps2tt(fontname)
+	except ValueError:
+		return 'font-family="%s"' % escape(fontname)
+	attributes = 'font-family="%s"' % FONT_FAMILIES.get(family, family)
+	if bold:
+		attributes += ' font-weight="bold"'
+	if italic:
+		attributes += ' font-style="italic"'
+	return attributes
+
+def svg_color(color):
+	return '#%02x%02x%02x' % tuple(int(round(255 * c)) for c in color.rgb())
+
+def svg_page(page, width, height, y=0):
+	# one laid out page as an <svg>, at y in whatever it's in; the page's
+	# y goes up from the bottom and the svg's down from the top
+	out = ['<svg x="0" y="%.2f" width="%.2f" height="%.2f" viewBox="0 0 %.2f %.2f" style="white-space:pre">' % (
+			y, width, height, width, height)]
+	out.append('<rect width="%.2f" height="%.2f" fill="white"/>' % (width, height))
+
+	# shading under the text, lines on top, as paint draws them
+	for rect in page.rects:
+		out.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="%s"/>' % (
+				rect.x, height - rect.y - rect.height, rect.width, rect.height, svg_color(rect.color)))
+
+	font = None
+	for item in page.texts:
+		if (item.font, item.size) != font:
+			if font is not None:
+				out.append('</g>')
+			font = (item.font, item.size)
+			out.append('<g %s font-size="%.2f">' % (font_attributes(item.font), item.size))
+		out.append('<text x="%.2f" y="%.2f">%s</text>' % (item.x, height - item.y, escape(item.text, False)))
+	if font is not None:
+		out.append('</g>')
+
+	stroke = None
+	for line in page.lines:
+		if (line.color, line.width, line.cap) != stroke:
+			if stroke is not None:
+				out.append('</g>')
+			stroke = (line.color, line.width, line.cap)
+			out.append('<g stroke="%s" stroke-width="%.2f" stroke-linecap="%s">' % (
+					svg_color(line.color), line.width, LINE_CAPS[line.cap]))
+		out.append('<line x1="%.2f" y1="%.2f" x2="%.2f" y2="%.2f"/>' % (
+				line.x1, height - line.y1, line.x2, height - line.y2))
+	if stroke is not None:
+		out.append('</g>')
+
+	out.append('</svg>')
+	return ''.join(out)
+
+#######################################################################################
+# renderers
+#######################################################################################
+
+# Lays charts out just as CanvasRenderer does, keeping each page instead of
+# painting it onto a canvas, and writes them all out as one document at the end;
+# subclasses say what the document is. Everything else (render, render_file,
+# songbooks, fit_pages) works as for the PDF renderers, with output getting
+# UTF-8 text instead of a PDF.
+class PreviewRenderer(CanvasRenderer):
+
+	def start_pdf(self, output):
+		self.start_layout()
+		self.output = output
+		self.pages = []
+		self.titles = []
+
+	def print_metadata(self, chart):
+		self.titles.append(chart.title)
+		CanvasRenderer.print_metadata(self, chart)
+
+	def paint(self, page):
+		self.pages.append(page)
+
+	def finish_pdf(self):
+		self.flush()
+		self.paint(self.finish_page(self.page))
+		data = self.document().encode('utf-8')
+		if isinstance(self.output, str):
+			with open(self.output, 'wb') as f:
+				f.write(data)
+		else:
+			self.output.write(data)
+
+	def document_title(self):
+		return escape(' / '.join(title for title in self.titles if title))
+
+# the pages one above the other in one SVG
+class SvgRenderer(PreviewRenderer):
+
+	extension = '.svg'
+	content_type = 'image/svg+xml'
+
+	def document(self):
+		step = self.dheight + PAGE_GAP
+		height = step * len(self.pages) - PAGE_GAP
+		out = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+				'<svg xmlns="http://www.w3.org/2000/svg" width="%.2f" height="%.2f" viewBox="0 0 %.2f %.2f">\n' % (
+						self.dwidth, height, self.dwidth, height),
+				'<title>%s</title>\n' % self.document_title()]
+		for (n, page) in enumerate(self.pages):
+			out.append(svg_page(page, self.dwidth, self.dheight, n * step))
+			out.append('\n')
+		out.append('</svg>\n')
+		return ''.join(out)
+
+# a web page with each page an SVG in it; songbook songs can be linked to as #song-N
+class HtmlRenderer(PreviewRenderer):
+
+	extension = '.html'
+	content_type = 'text/html; charset=utf-8'
+
+	def document(self):
+		out = ['<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n',
+				'<title>%s</title>\n' % self.document_title(),
+				'<style>body { margin: 0; background: %s; } svg { display: block; margin: %dpx auto; }</style>\n' % (
+						BACKGROUND_COLOR, PAGE_GAP),
+				'</head>\n<body>\n']
+		for page in self.pages:
+			for (number, title) in page.marks:
+				out.append('<a id="song-%d"></a>\n' % (number + 1))
+			out.append(svg_page(page, self.dwidth, self.dheight))
+			out.append('\n')
+		out.append('</body>\n</html>\n')
+		return ''.join(out)
+
+# the --preview choices
+PREVIEWS = OrderedDict([('svg', SvgRenderer), ('html', HtmlRenderer)])
@@ -0,0 +1,1578 @@
+# Copyright (c) 2016 Bonnie Schulkin. All Rights Reserved.
+#
+# This file is part of box_charts.
+#
+# box_charts is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# box_charts is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with box_charts. If not, see <http://www.gnu.org/licenses/>.
+
+
+#######################################################################################
+# rendering parsed charts to PDF, for chord_chart.py
+#
+# Everything that needs reportlab lives here, so that chord_chart.py can parse,
+# check and print its usage without importing it; it imports this module the
+# first time something is rendered. The charts come from chart_parser.py.
+#######################################################################################
+
+#######################################################################################
+# imports
+#######################################################################################
+
+from reportlab.pdfgen import canvas
+from reportlab.lib import colors
+from reportlab.lib.units import inch
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Frame, Spacer, Flowable, PageBreak, PageTemplate
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY
+from reportlab.pdfbase.pdfmetrics import stringWidth, getFont
+from reportlab.pdfbase.pdfdoc import PDFStream, PDFArray, PDFName, PDFZCompress, PDFBase85Encode
+from reportlab import rl_config
+from reportlab.lib.rl_accel import unicode2T1
+from reportlab.platypus.paragraph import ParaLines, FragLine
+# http://www.reportlab.com/apis/reportlab/2.4/platypus.html
+
+import os, sys
+from math import floor, ceil, isfinite
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from io import BytesIO
+from contextlib import contextmanager, nullcontext
+
+from chart_parser import (ChartError, ParseCache, PDF_DIR, REPEAT_CHAR, count_lyric_lines, error_message,
+		initialize_rows, lyric_occupancy, parse_stream, print_debug, read_chart, rescale_chart, transpose_chart)
+
+#######################################################################################
+# constants
+#######################################################################################
+DEFAULT_FONT = 'Helvetica'
+DEFAULT_BOLD_FONT = 'Helvetica-Bold'
+LYRIC_FONT = DEFAULT_FONT
+
+CHORD_TABLE_BORDER_COLOR = colors.black
+LYRIC_BACK_COLOR = colors.Color(.75,.75,.75,1) # light gray
+
+TOP_MARGIN = 0.25*inch
+LEFT_MARGIN = 0.75*inch
+
+CELL_MARGIN_H = 6 # default
+CELL_MARGIN_V = 3 # default
+FRAME_PADDING = 6 # default
+PAGE_NUMBER_FONT_SIZE = 9 # songbooks with contents number their pages
+LAYOUT_FUZZ = 1e-6 # how far platypus lets a flowable overrun the frame
+
+FIT_CACHE_SIZE = 4096 # fitted cell font sizes to remember
+SCALED_CACHE_SIZE = 8 # scales a renderer keeps the sizes, styles and spacers of
+MAX_FIT_STEPS = 10000 # sizes fit_font_size will try between a font size and 0
+METRICS_CACHE_SIZE = 65536 # string widths to remember per font
+FIT_FUZZ = 1e-6 # more than rounding can make of a cell's width, in points
+
+# how cells' font sizes are fitted: each on its own, or one size for all the
+# chords and one for all the lyrics in each measure row, or in each section
+FIT_MODES = ('cell', 'row', 'section')
+
+# --fit-pages tries scales in hundredths, which a scale line can give, down to MIN_SCALE
+SCALE_STEPS = 100
+MIN_SCALE = 0.25
+
+PROFILE_WORST_CELLS = 10 # cells listed by --profile
+SONGBOOK_PASSES = 3 # layouts tried to settle the contents' page numbers
+PROFILE_STAGES = ('parse', 'pages', 'elements', 'fit', 'build') # in the order they're reported
+
+#######################################################################################
+# fitting
+#######################################################################################
+
+# Glyph widths for one font, from reportlab's own tables, and the widths of
+# the strings measured in it at size 1. stringWidth sums the glyph widths (whole
+# thousandths of an em) and scales the sum by 0.001 and then the size, so doing
+# just the same here gives exactly its widths without walking the string again
+# for every size tried.
+class FontMetrics:
+
+	def __init__(self, fontname):
+		font = getFont(fontname)
+		self.fonts = [font] + font.substitutionFonts
+		self.glyphs = {} # character -> width
+		for code in range(256):
+			try:
+				char = bytes([code]).decode(font.encName)
+			except UnicodeDecodeError:
+				continue
+			if len(char) == 1 and char.encode(font.encName) == bytes([code]):
+				self.glyphs[char] = font.widths[code]
+		self.units = {} # text -> width at size 1
+		self.space = self.unit_width(' ')
+
+	def glyph_width(self, char):
+		# anything not in the font's encoding comes from the fonts stringWidth
+		# would substitute for it
+		width = self.glyphs.get(char)
+		if width is None:
+			width = sum(sum(map(font.widths.__getitem__, t)) for (font, t) in unicode2T1(char, self.fonts))
+			self.glyphs[char] = width
+		return width
+
+	def unit_width(self, text):
+		unit = self.units.get(text)
+		if unit is None:
+			try:
+				total = sum(map(self.glyphs.__getitem__, text))
+			except KeyError:
+				total = sum(map(self.glyph_width, text))
+			unit = total * 0.001
+			if len(self.units) >= METRICS_CACHE_SIZE:
+				self.units.clear()
+			self.units[text] = unit
+		return unit
+
+	def line_count(self, text, fontsize, maxwidth):
+		# how many lines simpleSplit would wrap the text into, breaking it in
+		# the same places
+		lines = text.split('\n')
+		if not maxwidth:
+			return len(lines)
+		space = self.space * fontsize
+		count = 0
+		for line in lines:
+			width = None
+			for word in line.split():
+				word_width = self.unit_width(word) * fontsize
+				if width is None:
+					count += 1
+					width = word_width
+				elif width + space + word_width <= maxwidth:
+					width = width + space + word_width
+				else:
+					count += 1
+					width = word_width
+		return count
+
+font_metrics_cache = {}
+
+def font_metrics(fontname):
+	metrics = font_metrics_cache.get(fontname)
+	if metrics is None:
+		metrics = font_metrics_cache[fontname] = FontMetrics(fontname)
+	return metrics
+
+def text_width(text, fontstyle, fontsize):
+	# stringWidth(text, fontstyle, fontsize), to the last bit
+	return font_metrics(fontstyle).unit_width(text) * fontsize
+
+def line_count(text, fontstyle, fontsize, maxwidth):
+	# len(simpleSplit(text, fontstyle, fontsize, maxwidth))
+	return font_metrics(fontstyle).line_count(text, fontsize, maxwidth)
+
+# What the fitting measures text with; a renderer fits with its own, so that a
+# RenderProfile can count one renderer's measurements without touching any
+# other's. This one measures with the FontMetrics tables.
+class TextMeasurer:
+
+	def text_width(self, text, fontstyle, fontsize):
+		return text_width(text, fontstyle, fontsize)
+
+	def line_count(self, text, fontstyle, fontsize, maxwidth):
+		return line_count(text, fontstyle, fontsize, maxwidth)
+
+MEASURER = TextMeasurer()
+
+def text_fits(text, fontstyle, fontsize, maxwidth, measurer=MEASURER):
+	if measurer.text_width(text, fontstyle, fontsize) > maxwidth:
+		return False
+	return measurer.line_count(text, fontstyle, fontsize, maxwidth) <= 1
+
+def fit_font_size(text, fontstyle, fontsize, maxwidth, step, measurer=MEASURER):
+	# Find the size that shrinking by step at a time would settle on: the first
+	# of fontsize, fontsize - step, fontsize - 2*step ... at which the text fits
+	# on one line, or the first one that isn't positive. Width is linear in the
+	# font size, so one measurement at full size gives a guess at the answer,
+	# and bisection takes care of any rounding near the edge. A size and step
+	# that would never get to 0, or only after MAX_FIT_STEPS, are a ValueError.
+
+	if not (isfinite(fontsize) and isfinite(step) and step > 0 and fontsize / step <= MAX_FIT_STEPS):
+		raise ValueError("can't fit text at size %r in steps of %r" % (fontsize, step))
+	if fontsize <= 0:
+		return fontsize
+	steps = int(ceil(fontsize / step))
+
+	full_width = measurer.text_width(text, fontstyle, fontsize)
+	if full_width <= maxwidth and measurer.line_count(text, fontstyle, fontsize, maxwidth) <= 1:
+		return fontsize
+
+	# candidate sizes, subtracted one step at a time so they match exactly;
+	# rounding can leave one more than steps, never many more
+	sizes = [fontsize]
+	while sizes[-1] > 0 and len(sizes) <= steps + 1:
+		sizes.append(sizes[-1] - step)
+
+	if full_width > 0:
+		guess = int(ceil((fontsize - fontsize * maxwidth / full_width) / step))
+	else:
+		guess = len(sizes) - 1
+
+	# sizes[lo] is too big, sizes[hi] fits (or is as small as we go)
+	lo = 0
+	hi = len(sizes) - 1
+	probes = [guess, guess - 1, guess + 1]
+	while hi - lo > 1:
+		if probes:
+			k = probes.pop(0)
+			if k <= lo or k >= hi:
+				continue
+		else:
+			k = (lo + hi) // 2
+
+		if sizes[k] <= 0 or text_fits(text, fontstyle, sizes[k], maxwidth, measurer):
+			hi = k
+		else:
+			lo = k
+
+	return sizes[hi]
+
+# The same chords and lyric fragments come up over and over, within a chart and
+# across a batch, so the sizes they were fitted to are remembered: the maxsize
+# most recently used, shared by every renderer in the process. It's called like
+# fit_font_size and works like lru_cache, except that the measurer isn't part of
+# what's looked up.
+FitCacheInfo = namedtuple('FitCacheInfo', 'hits misses maxsize currsize')
+
+class FitCache:
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.sizes = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def __call__(self, text, fontstyle, fontsize, maxwidth, step, measurer=MEASURER):
+		key = (text, fontstyle, fontsize, maxwidth, step)
+		with self.lock:
+			size = self.sizes.get(key)
+			if size is not None:
+				self.sizes.move_to_end(key)
+				self.hits += 1
+				return size
+			self.misses += 1
+
+		size = fit_font_size(text, fontstyle, fontsize, maxwidth, step, measurer)
+		with self.lock:
+			self.sizes[key] = size
+			if len(self.sizes) > self.maxsize:
+				self.sizes.popitem(last=False)
+		return size
+
+	def cache_info(self):
+		return FitCacheInfo(self.hits, self.misses, self.maxsize, len(self.sizes))
+
+	def cache_clear(self):
+		with self.lock:
+			self.sizes.clear()
+			self.hits = 0
+			self.misses = 0
+
+cached_fit_font_size = FitCache(FIT_CACHE_SIZE)
+
+def fit_cache_info():
+	# (hits, misses, maxsize, currsize)
+	return cached_fit_font_size.cache_info()
+
+#######################################################################################
+# profiling
+#######################################################################################
+
+# Collects where a ChartRenderer's time goes. A renderer given a profile calls:
+#   stage(name)   a context manager around each stage: 'parse', 'pages' (finding the
+#                 scale for fit_pages), 'elements' (making the flowables), 'fit'
+#                 (font fitting) and 'build' (laying them out and drawing them);
+#                 a stage inside another isn't counted in the
+#                 outer one, so fitting isn't in elements, and sections laid out as
+#                 they're made are in build
+#   count(name)   for each paragraph, style and table it creates
+#   cell(...)     for each cell it fits text into
+#   measurer()    once, for what to measure text with while fitting; this one
+#                 counts the text_width and line_count calls into the profile
+# Subclass it to hook in anything else.
+class RenderProfile:
+
+	def __init__(self):
+		self.seconds = OrderedDict()
+		self.inner = [] # time in stages inside the ones running
+		self.counts = OrderedDict()
+		self.cells = {}
+		self.measurements = 0
+
+	@contextmanager
+	def stage(self, name):
+		start = time.perf_counter()
+		self.inner.append(0.0)
+		try:
+			yield
+		finally:
+			seconds = time.perf_counter() - start
+			self.seconds[name] = self.seconds.get(name, 0.0) + seconds - self.inner.pop()
+			if self.inner:
+				self.inner[-1] += seconds
+
+	def count(self, name, n=1):
+		self.counts[name] = self.counts.get(name, 0) + n
+
+	def cell(self, texttype, text, fontsize, new_fontsize, step, measurements):
+		# shrinks is how many steps down from the full size the text had to go
+		shrinks = int(round((fontsize - new_fontsize) / step))
+		key = (texttype, text, fontsize)
+		if key in self.cells:
+			self.cells[key][3] += 1
+		else:
+			self.cells[key] = [new_fontsize, shrinks, measurements, 1]
+
+	def measurer(self):
+		return CountingMeasurer(self)
+
+	def measured(self, name):
+		self.measurements += 1
+		self.count(name)
+
+	def worst_cells(self, count=PROFILE_WORST_CELLS):
+		# the cells that had to shrink the most
+		cells = [item for item in self.cells.items() if item[1][1] > 0]
+		cells.sort(key=lambda item: (-item[1][1], -item[1][2], item[0]))
+		return cells[:count]
+
+	def report(self, out=sys.stderr):
+		out.write("stage times:\n")
+		for name in sorted(self.seconds, key=lambda name: PROFILE_STAGES.index(name) if name in PROFILE_STAGES else len(PROFILE_STAGES)):
+			out.write("  %-20s %9.2fms\n" % (name, self.seconds[name] * 1000))
+		out.write("counts:\n")
+		for (name, count) in self.counts.items():
+			out.write("  %-20s %9d\n" % (name, count))
+		out.write("worst cells (shrinks, measurements, final size, times seen):\n")
+		for ((texttype, text, fontsize), (new_fontsize, shrinks, measurements, seen)) in self.worst_cells():
+			out.write("  %4d %4d %6.2f/%-6.2f %4dx  %s [%s]\n" % (
+					shrinks, measurements, new_fontsize, fontsize, seen, texttype, text))
+
+# measures as TextMeasurer does, counting each measurement into a profile
+class CountingMeasurer(TextMeasurer):
+
+	def __init__(self, profile):
+		self.profile = profile
+
+	def text_width(self, text, fontstyle, fontsize):
+		self.profile.measured('text_width calls')
+		return text_width(text, fontstyle, fontsize)
+
+	def line_count(self, text, fontstyle, fontsize, maxwidth):
+		self.profile.measured('line_count calls')
+		return line_count(text, fontstyle, fontsize, maxwidth)
+
+#######################################################################################
+# flowables
+#######################################################################################
+
+# One row of measures in a section, fitted and ready to draw: col_widths for each
+# measure; chords[c] is (slot width, [(chord, font size), ...]) for measure c and
+# lyrics[n][c] its (lyric, font size) on lyric line n + 1; start_repeats and
+# end_repeats are the columns with repeat bars.
+MeasureRow = namedtuple('MeasureRow', 'col_widths chords lyrics start_repeats end_repeats')
+
+# The chords of one measure side by side, each centred in an equal slot, placed
+# just where a one-row Table of them would put them. Every measure has one, so
+# this saves doc.build laying out a nested Table per measure.
+class ChordCell(Flowable):
+
+	def __init__(self, paragraphs, slot_width, height, padding):
+		Flowable.__init__(self)
+		self.paragraphs = paragraphs
+		self.slot_width = slot_width
+		self.width = slot_width * len(paragraphs)
+		self.height = height
+		(self.left_padding, self.right_padding, self.top_padding, self.bottom_padding) = padding
+		self.hAlign = 'CENTER'
+
+	def wrap(self, availWidth, availHeight):
+		return (self.width, self.height)
+
+	def draw(self):
+		avail_width = self.slot_width - self.left_padding - self.right_padding
+		avail_height = self.height - self.top_padding - self.bottom_padding
+		x = 0
+		for para in self.paragraphs:
+			(w, h) = para.wrapOn(self.canv, avail_width, avail_height)
+			y = (self.height + self.bottom_padding - self.top_padding + h) / 2.0 - h
+			para.drawOn(self.canv, x + (self.slot_width + self.left_padding - self.right_padding - w) / 2.0, y)
+			x += self.slot_width
+
+# Where a song starts in a songbook: takes no room, and draws nothing but a
+# bookmark for it. ChartDocTemplate notes the page it lands on.
+class SongMarker(Flowable):
+	_ZEROSIZE = True
+
+	def __init__(self, number, title):
+		Flowable.__init__(self)
+		self.number = number
+		self.title = title
+
+	def wrap(self, availWidth, availHeight):
+		return (0, 0)
+
+	def draw(self):
+		add_bookmark(self.canv, self.number, self.title)
+
+def add_bookmark(canv, number, title):
+	key = 'song%d' % number
+	canv.bookmarkPage(key)
+	canv.addOutlineEntry(title, key, 0)
+
+# A Canvas that compresses each page's content as soon as the page is done. The
+# PDF is only written out when it's saved, and until then the pages are held in
+# memory: compressed, a long songbook's take a tenth of the room. The streams come
+# out just as reportlab would have compressed them when saving.
+class ChartCanvas(canvas.Canvas):
+
+	def showPage(self):
+		canvas.Canvas.showPage(self)
+		page = self._doc.Pages.pages[-1]
+		if page.compression and page.stream:
+			filters = [PDFBase85Encode, PDFZCompress] if rl_config.useA85 else [PDFZCompress]
+			content = page.stream
+			for f in reversed(filters):
+				content = f.encode(content)
+			stream = PDFStream(content=content)
+			stream.dictionary['Filter'] = PDFArray([PDFName(f.pdfname) for f in filters])
+			stream.__Comment__ = 'page stream'
+			page.Contents = stream
+			page.stream = None
+
+# SimpleDocTemplate, plus build() in pieces so the flowables can be laid out and
+# let go of as they're made: start_build, then place as often as there are more
+# flowables, then end_build. Pages come out just as build() would make them.
+class ChartDocTemplate(SimpleDocTemplate):
+
+	def start_build(self, on_page=None):
+		# on_page(canv, doc) draws on every page, like build's onFirstPage/onLaterPages
+		self._calc()
+		frame = Frame(self.leftMargin, self.bottomMargin, self.width, self.height, id='normal')
+		templates = [PageTemplate(id=name, frames=frame, pagesize=self.pagesize) for name in ('First', 'Later')]
+		if on_page is not None:
+			for template in templates:
+				template.beforeDrawPage = on_page
+		self.addPageTemplates(templates)
+		self._startBuild(canvasmaker=ChartCanvas)
+		self.canv._doctemplate = self
+
+	def place(self, flowables):
+		# lays out and draws the flowables, emptying the list
+		while flowables:
+			self.clean_hanging()
+			self.handle_flowable(flowables)
+
+	def end_build(self):
+		del self.canv._doctemplate
+		self._endBuild()
+
+	def afterFlowable(self, flowable):
+		if isinstance(flowable, SongMarker):
+			self.song_pages[flowable.number] = self.page
+
+#######################################################################################
+# chart renderer
+#######################################################################################
+
+# Renders parsed charts to PDF. Everything that depends on the chart's scale
+# (sizes, styles, spacers and the fitted cells' styles) is kept per instance
+# for the SCALED_CACHE_SIZE scales used last, and reused from one chart to the
+# next; use one renderer per thread. Give it a RenderProfile to see where
+# the time goes, a fit mode (one of FIT_MODES) to fit whole rows or sections
+# at one size, and fit_pages to shrink each chart onto that many pages.
+class ChartRenderer:
+
+	extension = '.pdf' # of the files render_file writes
+	content_type = 'application/pdf' # of what it renders, for chart_server
+
+	def __init__(self, parse_cache_dir=None, profile=None, fit='cell', fit_pages=None):
+		if fit not in FIT_MODES:
+			raise ValueError("fit must be one of %s, not %r" % (', '.join(FIT_MODES), fit))
+		self.fit = fit
+		self.fit_pages = fit_pages
+		self.page_fitter = None
+		self.scale = None
+		self.scaled = OrderedDict()
+		self.style_pool = None
+		self.parse_cache = ParseCache(parse_cache_dir)
+		self.profile = profile
+		self.measurer = MEASURER if profile is None else profile.measurer()
+		self.number_pages = False
+		self.dwidth, self.dheight = letter
+
+	def stage(self, name):
+		if self.profile is None:
+			return nullcontext()
+		return self.profile.stage(name)
+
+	def count(self, name):
+		if self.profile is not None:
+			self.profile.count(name)
+
+	def set_scale(self, scale):
+		if scale == self.scale:
+			return
+
+		self.scale = scale
+		if scale in self.scaled:
+			self.scaled.move_to_end(scale)
+		else:
+			self.set_scaled_constants()
+			self.create_styles()
+			self.create_spacers()
+			self.scaled[scale] = (self.sizes, self.styles, self.spacers, {})
+			# a long-running renderer sees any number of scales
+			if len(self.scaled) > SCALED_CACHE_SIZE:
+				self.scaled.popitem(last=False)
+		(self.sizes, self.styles, self.spacers, self.style_pool) = self.scaled[scale]
+
+	def scale_it(self, number):
+		return self.scale * number
+
+	def set_scaled_constants(self):
+
+		self.sizes = {}
+		
+		self.sizes['TITLE_FONT_SIZE'] = self.scale_it(24)
+		self.sizes['MDATA_FONT_SIZE'] = self.scale_it(12)
+		self.sizes['CHORD_FONT_SIZE'] = self.scale_it(16)
+		self.sizes['LYRIC_FONT_SIZE'] = self.scale_it(11)
+		self.sizes['SECTION_FONT_SIZE'] = self.scale_it(14)
+
+		self.sizes['CHORD_TABLE_BORDER_WIDTH'] = self.scale_it(1)
+
+		self.sizes['LYRIC_ROW_HEIGHT'] = self.sizes['LYRIC_FONT_SIZE'] * 1.2
+		self.sizes['CHORD_ROW_HEIGHT'] = self.sizes['CHORD_FONT_SIZE'] * 2
+		self.sizes['CHORD_RIGHT_PADDING'] = self.sizes['CHORD_FONT_SIZE']/1.6
+
+		self.sizes['TABLE_SPACER_SIZE'] = self.scale_it(20)
+
+		# for multi-chord cells
+		self.sizes['MINICHORD_RIGHT_PADDING'] = self.scale_it(0)
+		self.sizes['MINICHORD_LEFT_PADDING'] = self.scale_it(0)
+		self.sizes['MINICHORD_BOTTOM_PADDING'] = self.sizes['CHORD_FONT_SIZE']/1.6 
+		self.sizes['MINICHORD_TOP_PADDING'] = self.scale_it(0)
+
+#######################################################################################
+# pdf styles
+#######################################################################################
+
+	def create_styles(self):
+
+		# paragraph styes
+		self.styles = getSampleStyleSheet()
+		self.styles.add(ParagraphStyle(
+				'title_text',
+				fontName=DEFAULT_BOLD_FONT, 
+				fontSize=self.sizes['TITLE_FONT_SIZE'],
+				alignment=TA_CENTER))
+		self.styles.add(ParagraphStyle(
+				'mdata_text',
+				fontName=DEFAULT_FONT, 
+				fontSize=self.sizes['MDATA_FONT_SIZE'],
+				alignment=TA_CENTER))
+		self.styles.add(ParagraphStyle(
+				'section_header_text',
+				fontName=DEFAULT_BOLD_FONT, 
+				fontSize=self.sizes['SECTION_FONT_SIZE'],
+				alignment=TA_LEFT))
+		self.styles.add(ParagraphStyle(
+				'chord_text',
+				fontName=DEFAULT_BOLD_FONT, 
+				fontSize=self.sizes['CHORD_FONT_SIZE'],
+				alignment=TA_CENTER))
+		self.styles.add(ParagraphStyle(
+				'lyric_text',
+				fontName=LYRIC_FONT, 
+				fontSize=self.sizes['LYRIC_FONT_SIZE'],
+				alignment=TA_LEFT))
+		self.styles.add(ParagraphStyle(
+				'toc_text',
+				fontName=DEFAULT_FONT, 
+				fontSize=self.sizes['MDATA_FONT_SIZE'],
+				leading=1.5*self.sizes['MDATA_FONT_SIZE'],
+				alignment=TA_LEFT))
+		if self.profile is not None:
+			self.profile.count('styles created', len(self.styles.byName))
+
+	def get_fit_style(self, fontstyle, fontsize, align):
+		# fitted cells share one style per font, size and alignment at each scale;
+		# these stay out of the stylesheet so it doesn't grow with the length of
+		# the chart
+		key = (fontstyle, fontsize, align)
+		if key not in self.style_pool:
+			self.count('styles created')
+			self.style_pool[key] = ParagraphStyle(
+					'fit_%s_%r_%s' % key,
+					fontName=fontstyle,
+					fontSize=fontsize,
+					alignment=align)
+		return self.style_pool[key]
+
+	def create_spacers(self):
+
+		self.spacers = {}
+		
+		self.spacers['section_title'] = Spacer(1, self.sizes['MDATA_FONT_SIZE']/2)
+		self.spacers['section'] = Spacer(1, self.sizes['TABLE_SPACER_SIZE'])
+		self.spacers['title'] = Spacer(1, self.scale_it(0.8*self.sizes['TITLE_FONT_SIZE'])) # double scale
+		self.spacers['mdata'] = Spacer(1, self.scale_it(self.sizes['MDATA_FONT_SIZE'])) # double scale
+		self.spacers['post_chord-lyric'] = Spacer(0,self.sizes['LYRIC_FONT_SIZE'])
+
+	def get_spacer(self, name):
+		# a fresh copy each time: platypus marks a flowable that gets pushed to the
+		# next page, and if a shared Spacer is pushed twice in a long chart it gives
+		# up with LayoutError
+		spacer = self.spacers[name]
+		return Spacer(spacer.width, spacer.height)
+
+#######################################################################################
+# table layout
+#######################################################################################
+
+	def get_col_array(self, colcount, total_colcount):
+		colwidth = (self.dwidth - 2*LEFT_MARGIN) / total_colcount
+		return (colwidth, [colwidth] * colcount)
+
+	def get_cols(self, chord_array, measure_number, col_count, default_col_array):
+		# will there be an incomplete line? 
+		hanging_line = len(chord_array) % col_count
+
+		# short last line? 
+		if hanging_line and len(chord_array) - measure_number < col_count:
+			this_col_count = len(chord_array) % col_count
+			(this_width, this_col_array) = self.get_col_array(this_col_count, col_count)
+		else:
+			this_col_count = col_count
+			this_col_array = default_col_array
+			
+		return (this_col_count, this_col_array)
+
+	def fit_text(self, texttype, input_text, fontsize, fontstyle, maxwidth):
+
+# 	if texttype == 'lyric' or len(input_text) <= 1: 
+# 		text = input_text
+#   		small_fontsize = fontsize
+# 	else:
+# 		text = input_text[0]
+# 		small_fontsize = str(fontsize*0.7)
+# 		for i in range(1,len(input_text)):
+# 			if input_text[i] in ['#', 'b']:
+# 				text += '<super>' + input_text[i] + '</super>'
+# 			else:
+# 				text += input_text[i]
+# 	
+# 	if '<super>' in text:
+# 		print text
+
+		text = input_text
+		step = self.scale_it(0.5)
+		if self.profile is None:
+			new_fontsize = cached_fit_font_size(text, fontstyle, fontsize, maxwidth, step, self.measurer)
+		else:
+			measurements = self.profile.measurements
+			with self.profile.stage('fit'):
+				new_fontsize = cached_fit_font_size(text, fontstyle, fontsize, maxwidth, step, self.measurer)
+			self.profile.cell(texttype, text, fontsize, new_fontsize, step, self.profile.measurements - measurements)
+		
+# 	if text == 'something from the':
+# 		print "text width: " + str(text_width) + " font size: " + str(fontsize)
+		
+		if new_fontsize <= 0:
+			raise ChartError("can't print this " + texttype + ": [" + text + "] too wide at any size")
+
+		return new_fontsize
+
+	def fit_together(self, texttype, cells, fontsize, fontstyle):
+		# The one size that all the cells, (text, maxwidth) each, fit at. Their
+		# widths at size 1, measured together, say which cell needs the most
+		# shrinking, so only that one is fitted and the rest just checked at its
+		# size; if one of them doesn't fit after all (a line break in it, say)
+		# they're all fitted.
+		if not cells:
+			return fontsize
+		metrics = font_metrics(fontstyle)
+		units = [metrics.unit_width(text) for (text, maxwidth) in cells]
+		crowding = [unit / maxwidth if maxwidth > 0 else float('inf') for (unit, (text, maxwidth)) in zip(units, cells)]
+		(text, maxwidth) = cells[crowding.index(max(crowding))]
+
+		new_fontsize = self.fit_text(texttype, text, fontsize, fontstyle, maxwidth)
+		with self.stage('fit'):
+			# a text with single spaces between its words wraps only if it's
+			# wider than the room, so one with room to spare fits as it is
+			fits = all(unit * new_fontsize + FIT_FUZZ <= maxwidth and ' '.join(text.split()) == text
+					or text_fits(text, fontstyle, new_fontsize, maxwidth, self.measurer)
+					for (unit, (text, maxwidth)) in zip(units, cells))
+		if not fits:
+			new_fontsize = min(self.fit_text(texttype, text, fontsize, fontstyle, maxwidth) for (text, maxwidth) in cells)
+		return new_fontsize
+
+	def fit_paragraph(self, text, fontstyle, fontsize, align):
+		self.count('paragraphs')
+		return Paragraph(text, self.get_fit_style(fontstyle, fontsize, align))
+
+#######################################################################################
+# measure rows
+#######################################################################################
+
+	def measure_rows(self, data, cols):
+		# Lays a section out into rows of measures and fits their text as
+		# self.fit says. Yields a MeasureRow per row; the engines draw them
+		# however they like.
+		rows = self.unfitted_rows(data, cols)
+		if self.fit == 'cell':
+			for row in rows:
+				yield self.fit_cells(row)
+		elif self.fit == 'row':
+			for row in rows:
+				yield self.fit_rows([row])[0]
+		else:
+			yield from self.fit_rows(list(rows))
+
+	def unfitted_rows(self, data, cols):
+		# the MeasureRows, with None for every font size
+
+		# get col width and make an array for the table
+		(col_width, col_array) = self.get_col_array(cols, cols)
+
+		# for easier future reference
+		chords = data.chords
+		lyrics = data.lyrics
+		occupancy = lyric_occupancy(lyrics)
+
+		# initialize column count and lyric lines for the first go-around
+		(this_col_count, this_col_array) = self.get_cols(chords, 0, cols, col_array)
+		lyric_total = count_lyric_lines(occupancy, 0, this_col_count)
+		row_count = lyric_total + 1 
+		row_chords = []
+		row_lyrics = initialize_rows(lyric_total)
+		col_counter = 0
+		# track repeat measures
+		start_repeat_measures = []
+		end_repeat_measures = []
+
+		# process the data
+		for i in range(len(chords)):
+
+			rnum = int(floor (i / cols))
+			cnum = col_counter
+# 		print "i" + str(i) + " rnum" + str(rnum) + " cnum" + str(cnum)
+			
+			# look for repeats
+			chord_text = chords[i]
+			if chord_text[0] == REPEAT_CHAR:
+				start_repeat_measures.append(cnum)
+				chord_text = chord_text[1:]
+			elif chord_text[-1] == REPEAT_CHAR:
+				end_repeat_measures.append(cnum)
+				chord_text = chord_text[:-1]
+			
+			# the multi-chords share the cell equally
+			chord_list = chord_text.split(' ')
+			chordnum = len(chord_list)	
+			
+			chord_width = (col_width - self.sizes['CHORD_RIGHT_PADDING'])/chordnum
+			row_chords.append((chord_width, [(chd, None) for chd in chord_list]))
+
+			# then the lyrics
+			for l in range(1,row_count):
+				if i >= len(lyrics[l - 1]):
+					lyric_text = ''
+				else:
+					lyric_text = lyrics[l - 1][i]
+				row_lyrics[l - 1].append((lyric_text, None))
+
+			# increment column counter
+			col_counter += 1
+
+			# time to draw the measure row? 
+			if col_counter == this_col_count:
+				yield MeasureRow(this_col_array, row_chords, [row_lyrics[l] for l in range(lyric_total)],
+						start_repeat_measures, end_repeat_measures)
+		
+				# re-initialize column count and lyric lines for the next go-around
+				(this_col_count, this_col_array) = self.get_cols(chords, i+1, cols, col_array)
+				lyric_total = count_lyric_lines(occupancy, i+1, this_col_count)
+				row_count = lyric_total + 1 
+				row_chords = []
+				row_lyrics = initialize_rows(lyric_total)
+				col_counter = 0
+				start_repeat_measures = []
+				end_repeat_measures = []
+
+# 			if rnum == 4:
+# 				print i + 1
+# 				print "thi_cols" + str(this_col_count)
+# 				print "lyric_total" + str(lyric_total)
+
+	def chord_room(self, slot_width):
+		return slot_width - self.sizes['MINICHORD_RIGHT_PADDING'] - self.sizes['MINICHORD_LEFT_PADDING']
+
+	def lyric_room(self, col_width):
+		return col_width - 2*CELL_MARGIN_H
+
+	def fit_cells(self, row):
+		# each chord and lyric at the biggest size it fits at, measure by measure
+		chords = []
+		lyrics = [[] for lyric_line in row.lyrics]
+		for (c, (slot_width, chord_sizes)) in enumerate(row.chords):
+			avail_width = self.chord_room(slot_width)
+			chords.append((slot_width, [(chd, self.fit_text('chord', chd, self.sizes['CHORD_FONT_SIZE'], DEFAULT_BOLD_FONT, avail_width))
+					for (chd, size) in chord_sizes]))
+			for (lyric_line, fitted) in zip(row.lyrics, lyrics):
+				lyric_text = lyric_line[c][0]
+				fitted.append((lyric_text, self.fit_text('lyric', lyric_text, self.sizes['LYRIC_FONT_SIZE'], LYRIC_FONT, self.lyric_room(row.col_widths[c]))))
+		return row._replace(chords=chords, lyrics=lyrics)
+
+	def fit_rows(self, rows):
+		# all the chords in the rows at one size, and all the lyrics at another
+		chord_cells = []
+		lyric_cells = []
+		for row in rows:
+			for (slot_width, chord_sizes) in row.chords:
+				chord_cells.extend((chd, self.chord_room(slot_width)) for (chd, size) in chord_sizes)
+			for lyric_line in row.lyrics:
+				lyric_cells.extend((lyric_text, self.lyric_room(col_width)) for ((lyric_text, size), col_width) in zip(lyric_line, row.col_widths))
+		chord_size = self.fit_together('chord', chord_cells, self.sizes['CHORD_FONT_SIZE'], DEFAULT_BOLD_FONT)
+		lyric_size = self.fit_together('lyric', lyric_cells, self.sizes['LYRIC_FONT_SIZE'], LYRIC_FONT)
+
+		return [row._replace(
+				chords=[(slot_width, [(chd, chord_size) for (chd, size) in chord_sizes]) for (slot_width, chord_sizes) in row.chords],
+				lyrics=[[(lyric_text, lyric_size) for (lyric_text, size) in lyric_line] for lyric_line in row.lyrics])
+			for row in rows]
+
+#######################################################################################
+# create_table
+#######################################################################################
+
+	def create_table(self, data, cols, mnum): 
+		for row in self.measure_rows(data, cols):
+			self.add_measure_row(row)
+			self.add_spacer('post_chord-lyric')
+
+	def add_measure_row(self, row):
+#  	tstyles_start = [('VALIGN', (0,0), (-1,-1), 'MIDDLE')]
+		tstyles_start = [('VALIGN', (0,0), (-1,-1), 'MIDDLE'), ('ALIGN', (0, 0), (-1,-1), 'CENTER')]
+		this_col_count = len(row.col_widths)
+		lyric_total = len(row.lyrics)
+		row_count = lyric_total + 1 
+
+		# a chord cell to contain each measure's multi-chords
+		chord_cells = []
+		for (chord_width, chord_sizes) in row.chords:
+			chord_paras = []
+			for (chd, fontsize) in chord_sizes:
+				chord_paras.append(self.fit_paragraph(chd, DEFAULT_BOLD_FONT, fontsize, TA_CENTER))
+# 			http://www.reportlab.com/apis/reportlab/2.4/platypus.html
+
+			self.count('chord cells')
+			chord_cells.append(ChordCell(chord_paras, chord_width, self.sizes['CHORD_ROW_HEIGHT'],
+									(self.sizes['MINICHORD_LEFT_PADDING'], self.sizes['MINICHORD_RIGHT_PADDING'],
+									self.sizes['MINICHORD_TOP_PADDING'], self.sizes['MINICHORD_BOTTOM_PADDING'])))
+
+		# then the lyrics
+		tdata = [chord_cells]
+		for lyric_line in row.lyrics:
+			tdata.append([self.fit_paragraph(lyric_text, LYRIC_FONT, fontsize, TA_LEFT) for (lyric_text, fontsize) in lyric_line])
+
+		tstyles = []
+		tstyles += tstyles_start # can't just say tstyles = tstyles_start; tstyles_start starts changin'
+		
+		# row heights
+		rheights = [self.sizes['CHORD_ROW_HEIGHT']] + [self.sizes['LYRIC_ROW_HEIGHT']] * lyric_total
+
+		# chords style
+		tstyles.append(('GRID', (0, 0), (this_col_count - 1, 0), self.sizes['CHORD_TABLE_BORDER_WIDTH'],CHORD_TABLE_BORDER_COLOR))
+		tstyles.append(('RIGHTPADDING', (0, 0), (this_col_count - 1, 0), self.sizes['CHORD_RIGHT_PADDING']))
+
+		# lyrics shading every other row
+		for lnum in range(1,row_count):
+			if lnum % 2 == 0:				
+				tstyles.append(('BACKGROUND', (0, lnum), (this_col_count - 1, lnum), LYRIC_BACK_COLOR))
+
+		# repeat measures
+		#line commands are like 
+		#op, start, stop, weight, colour, cap, dashes, join, linecount, linespacing 
+		for coord in row.start_repeats:
+			tstyles.append(('LINEBEFORE', (coord,0), (coord,0), 3*self.sizes['CHORD_TABLE_BORDER_WIDTH'], CHORD_TABLE_BORDER_COLOR, 2))
+# 		tstyles.append(('LINEBEFORE', (coord,0), (coord,0), 3*self.sizes['CHORD_TABLE_BORDER_WIDTH'], CHORD_TABLE_BORDER_COLOR, 2, [], 2, 2, 3*self.sizes['CHORD_TABLE_BORDER_WIDTH']))
+		for coord in row.end_repeats:
+			tstyles.append(('LINEAFTER', (coord,0), (coord,0), 3*self.sizes['CHORD_TABLE_BORDER_WIDTH'], CHORD_TABLE_BORDER_COLOR, 2))
+
+		self.count('tables')
+		self.elements.append(Table(tdata, 
+								colWidths=row.col_widths, 
+								rowHeights=rheights, 
+								style=tstyles, 
+								hAlign='LEFT'))
+
+#######################################################################################
+# start pdf
+#######################################################################################
+	def start_pdf(self, output):
+		# output is a file name or a writable file-like object
+		self.doc = ChartDocTemplate(output, pagesize=letter)
+		self.elements = []
+		self.song_pages = {}
+		self.doc.song_pages = self.song_pages
+
+		# margins
+		self.doc.topMargin = TOP_MARGIN
+		self.doc.leftMargin = LEFT_MARGIN
+		self.doc.bottomMargin = TOP_MARGIN
+		self.doc.rightMargin = LEFT_MARGIN
+
+		self.doc.start_build(self.draw_page_number if self.number_pages else None)
+
+	def add_paragraph(self, text, style_name):
+		self.count('paragraphs')
+		self.elements.append(Paragraph(text, self.styles[style_name]))
+
+	def add_spacer(self, name):
+		self.elements.append(self.get_spacer(name))
+
+	def add_page_break(self):
+		self.elements.append(PageBreak())
+
+	def add_song_marker(self, number, title):
+		self.elements.append(SongMarker(number, title))
+
+#######################################################################################
+# print metadata 
+#######################################################################################
+	def print_metadata(self, chart):
+		# title
+		if chart.title is not None:
+			self.add_paragraph(chart.title, 'title_text')
+		else:
+			print_debug("WARNING: no title")
+
+		if chart.other:
+			self.add_spacer('title')
+			for line in chart.other:
+				self.add_paragraph(line, 'mdata_text')
+				self.add_spacer('mdata')
+
+#######################################################################################
+# print measures 
+#######################################################################################
+
+	def print_measures(self, sections, flush=True):
+		# each section is laid out as soon as it's made, unless flush is False
+		# (a songbook lays out only the charts that make it through whole)
+		running_count = 0
+		mcount = 0
+
+		for section in sections:
+			name = section.name
+			cols = int(section.width)
+			chords = section.chords
+
+			# print section title
+			self.add_spacer('section')
+			if name:
+				self.add_paragraph(name, 'section_header_text')
+				self.add_spacer('section_title')
+		
+			# make tables for the measure lines
+			t = self.create_table(section, cols, running_count)
+
+			running_count += len(chords)
+			if flush:
+				self.flush()
+
+#######################################################################################
+# finish pdf
+#######################################################################################
+	def flush(self):
+		# lay out and draw what's been added so far, and let it go
+		with self.stage('build'):
+			self.doc.place(self.elements)
+
+	def finish_pdf(self):
+		self.flush()
+		self.doc.end_build()
+
+	def draw_page_number(self, canv, doc):
+		canv.saveState()
+		canv.setFont(DEFAULT_FONT, PAGE_NUMBER_FONT_SIZE)
+		canv.drawCentredString(self.dwidth / 2.0, TOP_MARGIN / 2.0, str(doc.page))
+		canv.restoreState()
+
+#######################################################################################
+# render
+#######################################################################################
+
+	def build(self, chart, output):
+		if self.fit_pages is not None:
+			self.build_to_pages(chart, output)
+		else:
+			self.build_pdf(chart, output)
+
+	def build_pdf(self, chart, output):
+		with self.stage('elements'):
+			self.set_scale(chart.scale)
+			self.start_pdf(output)
+			self.print_metadata(chart)
+			self.print_measures(chart.sections)
+		with self.stage('build'):
+			self.finish_pdf()
+
+	def pages_built(self):
+		return self.doc.page
+
+	def build_to_pages(self, chart, output):
+		# The chart at the biggest scale, up to its own, that fits it on
+		# fit_pages pages. The page fitter finds it from the heights alone, and
+		# it's built once to make sure; if that takes more pages after all,
+		# the next scale down is tried.
+		if self.page_fitter is None:
+			self.page_fitter = PageFitter()
+		with self.stage('pages'):
+			steps = self.page_fitter.fit_steps(chart, self.fit_pages)
+
+		while True:
+			scale = chart.scale if steps is None else steps / SCALE_STEPS
+			pdf = BytesIO()
+			self.build_pdf(rescale_chart(chart, scale), pdf)
+			if self.pages_built() <= self.fit_pages:
+				break
+			steps = (round(chart.scale * SCALE_STEPS) if steps is None else steps) - 1
+			if steps < MIN_SCALE * SCALE_STEPS:
+				raise ChartError("doesn't fit on %s at any scale" % page_count_text(self.fit_pages))
+
+		if isinstance(output, str):
+			with open(output, 'wb') as f:
+				f.write(pdf.getvalue())
+		else:
+			output.write(pdf.getvalue())
+
+	def render(self, chart, output=None):
+		# chart is the chart text, or a file-like object to read it from. The PDF
+		# goes to output (any writable file-like object) if there is one, and is
+		# returned as bytes if not. Nothing touches the filesystem either way.
+		with self.stage('parse'):
+			if isinstance(chart, str):
+				chart = self.parse_cache.parse(chart)
+			else:
+				chart = parse_stream(chart)
+
+		if output is not None:
+			self.build(chart, output)
+			return output
+
+		pdf = BytesIO()
+		self.build(chart, pdf)
+		return pdf.getvalue()
+
+	def render_file(self, filename, pdf_dir=None, keys=None, from_key=None):
+		# Renders the chart as written, or from one parse into each of keys
+		# (from from_key, or the key the chart says it's in). Returns the list
+		# of PDFs written.
+		with self.stage('parse'):
+			chart = self.parse_cache.parse(read_chart(filename))
+		if chart.title is None:
+			raise ChartError("chart has no title line")
+
+		if pdf_dir is None:
+			pdf_dir = PDF_DIR
+
+		if not keys:
+			pdf_file = os.path.join(pdf_dir, chart.title + self.extension)
+			self.build(chart, pdf_file)
+			return [pdf_file]
+
+		from_key = from_key or chart.key
+		if from_key is None:
+			raise ChartError("don't know what key the chart is in; add a key change line or give a from key")
+
+		pdf_files = []
+		for key in keys:
+			pdf_file = os.path.join(pdf_dir, chart.title + ' - ' + key + self.extension)
+			self.build(transpose_chart(chart, from_key, key), pdf_file)
+			pdf_files.append(pdf_file)
+		return pdf_files
+
+#######################################################################################
+# songbook
+#######################################################################################
+
+	def print_contents(self, entries):
+		self.add_paragraph('Contents', 'title_text')
+		self.add_spacer('title')
+		for (title, page) in entries:
+			self.add_paragraph('%s \u2014 %s' % (title, page), 'toc_text')
+
+	def build_songbook(self, charts, output, contents=None):
+		# Every chart in one document, each starting a new page, after a table
+		# of contents if there's a list of (title, page) for one. A chart that
+		# can't be rendered is left out. Returns the page each chart starts on
+		# and the errors for those left out, both by index into charts.
+		errors = {}
+		self.number_pages = contents is not None
+		with self.stage('elements'):
+			self.start_pdf(output)
+			if contents is not None:
+				self.set_scale(1)
+				self.print_contents(contents)
+
+			# each song is laid out once it's all there
+			new_page = contents is not None
+			for (number, chart) in enumerate(charts):
+				start = len(self.elements)
+				try:
+					if chart.title is None:
+						raise ChartError("chart has no title line")
+					if new_page:
+						self.add_page_break()
+					self.set_scale(chart.scale)
+					self.add_song_marker(number, chart.title)
+					self.print_metadata(chart)
+					self.print_measures(chart.sections, flush=False)
+				except Exception as e:
+					# any chart that can't be drawn, not just bad chart data,
+					# is left out rather than taking the book down with it
+					del self.elements[start:]
+					errors[number] = error_message(e)
+					continue
+				self.flush()
+				new_page = True
+
+		with self.stage('build'):
+			self.finish_pdf()
+		self.number_pages = False
+		return (self.song_pages, errors)
+
+	def render_songbook(self, charts, output, contents=False):
+		# Renders the parsed charts into one PDF, written to output (a file name or
+		# a writable file-like object). The contents' page numbers come from laying
+		# the book out first, and it's laid out again if putting them in moved
+		# anything. Returns the errors for the charts left out, by index.
+		if not contents:
+			return self.build_songbook(charts, output)[1]
+
+		(pages, errors) = self.build_songbook(charts, BytesIO(), [(chart.title, '') for chart in charts])
+		for attempt in range(SONGBOOK_PASSES):
+			pdf = BytesIO()
+			(new_pages, errors) = self.build_songbook(charts, pdf, [(charts[n].title, pages[n]) for n in sorted(pages)])
+			if new_pages == pages:
+				break
+			pages = dict(new_pages)
+
+		if isinstance(output, str):
+			with open(output, 'wb') as f:
+				f.write(pdf.getvalue())
+		else:
+			output.write(pdf.getvalue())
+		return errors
+
+#######################################################################################
+# canvas engine
+#######################################################################################
+
+# What a laid out page holds, in points from the bottom left of the page: text
+# (x and y are the start of its baseline), shaded rectangles, and lines (cap as
+# for canvas.setLineCap); marks are the (number, title) of songbook songs
+# starting on it.
+TextItem = namedtuple('TextItem', 'x y text font size')
+RectItem = namedtuple('RectItem', 'x y width height color')
+LineItem = namedtuple('LineItem', 'x1 y1 x2 y2 width color cap')
+
+class LayoutPage:
+	__slots__ = ('number', 'texts', 'rects', 'lines', 'marks')
+
+	def __init__(self, number):
+		self.number = number
+		self.texts = []
+		self.rects = []
+		self.lines = []
+		self.marks = []
+
+# Renders the same charts as ChartRenderer without platypus. The chart is a
+# rigid grid, so instead of handing flowables to SimpleDocTemplate it works out
+# where everything goes itself: each flowable platypus would get becomes a block
+# of rows (kept in elements; None is a page break), the blocks are stacked down
+# the frame and broken across pages just as
+# platypus breaks them (measure rows between table rows, anything else moved
+# whole to the next page), and the pages are drawn straight onto a canvas.
+# layout() gives the laid out pages without drawing them.
+class CanvasRenderer(ChartRenderer):
+
+	def start_pdf(self, output):
+		# output is a file name or a writable file-like object
+		self.start_layout()
+		self.canv = ChartCanvas(output, pagesize=(self.dwidth, self.dheight))
+
+	def start_layout(self):
+		self.elements = []
+		self.song_pages = {}
+		self.set_frame()
+
+		# the page being filled, and how far down it
+		self.page = LayoutPage(1)
+		self.y = self.frame_top
+
+	def set_frame(self):
+		# where the frame platypus would lay the chart out in is
+		self.frame_x = LEFT_MARGIN + FRAME_PADDING
+		self.frame_width = self.dwidth - 2*LEFT_MARGIN - 2*FRAME_PADDING
+		self.frame_top = self.dheight - TOP_MARGIN - FRAME_PADDING
+		self.frame_bottom = TOP_MARGIN + FRAME_PADDING
+
+	def pages_built(self):
+		return self.page.number
+
+	# a block is (splittable, rows), each row (height, method laying it out, arguments)
+
+	def add_paragraph(self, text, style_name):
+		self.count('paragraphs')
+		para = Paragraph(text, self.styles[style_name])
+		(width, height) = para.wrap(self.frame_width, self.frame_top - self.frame_bottom)
+		self.elements.append((False, [(height, self.layout_paragraph, (para,))]))
+
+	def add_spacer(self, name):
+		self.elements.append((False, [(self.spacers[name].height, None, ())]))
+
+	def add_page_break(self):
+		self.elements.append(None)
+
+	def add_song_marker(self, number, title):
+		self.elements.append((False, [(0, self.layout_song_marker, (number, title))]))
+
+	def add_measure_row(self, row):
+		positions = [self.frame_x]
+		for col_width in row.col_widths:
+			positions.append(positions[-1] + col_width)
+
+		# the sizes go along too, since a songbook lays out charts of different scales
+		sizes = self.sizes
+		rows = [(sizes['CHORD_ROW_HEIGHT'], self.layout_chords, (sizes, row, positions))]
+		for (lnum, lyric_line) in enumerate(row.lyrics):
+			rows.append((sizes['LYRIC_ROW_HEIGHT'], self.layout_lyrics, (sizes, row, positions, lnum + 1, lyric_line)))
+		self.elements.append((True, rows))
+
+	def flush(self):
+		# lay out what's been added so far, and paint each page it fills
+		with self.stage('build'):
+			for page in self.layout():
+				self.paint(page)
+
+	def finish_pdf(self):
+		self.flush()
+		self.paint(self.finish_page(self.page))
+		self.canv.save()
+
+#######################################################################################
+# page layout
+#######################################################################################
+
+	def layout(self):
+		# lays out the blocks added since last time, yielding each page as it
+		# fills up; the last one stays in self.page for more
+		elements = self.elements
+		self.elements = []
+		for block in elements:
+			if block is None:
+				yield self.new_page()
+				continue
+
+			(splittable, rows) = block
+			postponed = False
+			while rows:
+				height = sum(row[0] for row in rows)
+				if (self.y > self.frame_bottom or height == 0) and self.y - height >= self.frame_bottom - LAYOUT_FUZZ:
+					placed = rows
+				else:
+					# as many whole rows as fit, if it's a measure row
+					placed = []
+					used = 0
+					for row in rows if splittable else ():
+						if used + row[0] > self.y - self.frame_bottom:
+							break
+						used += row[0]
+						placed.append(row)
+
+					if not placed:
+						if postponed:
+							raise ChartError("too tall to fit on a page")
+						postponed = True
+						yield self.new_page()
+						continue
+					postponed = False
+
+				rows = rows[len(placed):]
+				for (row_height, layout_row, args) in placed:
+					self.y -= row_height
+					if layout_row is not None:
+						layout_row(self.page, self.y, *args)
+
+	def new_page(self):
+		# finishes the page being filled and starts the next
+		page = self.finish_page(self.page)
+		self.page = LayoutPage(page.number + 1)
+		self.y = self.frame_top
+		return page
+
+	def finish_page(self, page):
+		if self.number_pages:
+			number = str(page.number)
+			x = (self.dwidth - stringWidth(number, DEFAULT_FONT, PAGE_NUMBER_FONT_SIZE)) / 2.0
+			page.texts.append(TextItem(x, TOP_MARGIN / 2.0, number, DEFAULT_FONT, PAGE_NUMBER_FONT_SIZE))
+		return page
+
+	def layout_song_marker(self, page, bottom, number, title):
+		self.song_pages[number] = page.number
+		page.marks.append((number, title))
+
+	def layout_paragraph(self, page, bottom, para):
+		# the lines just as the paragraph breaks and draws them
+		style = para.style
+		bl_para = para.blPara
+		if not bl_para.lines:
+			return
+
+		if bl_para.kind == 0:
+			y = bottom + para.height - bl_para.fontSize
+			for (extra_space, words) in bl_para.lines:
+				x = self.frame_x + self.align_offset(style.alignment, extra_space)
+				page.texts.append(TextItem(x, y, ' '.join(words), bl_para.fontName, bl_para.fontSize))
+				y -= style.leading
+		else:
+			y = bottom + para.height - bl_para.lines[0].fontSize
+			for line in bl_para.lines:
+				x = self.frame_x + self.align_offset(style.alignment, line.extraSpace)
+				for frag in line.words:
+					page.texts.append(TextItem(x, y, frag.text, frag.fontName, frag.fontSize))
+					x += stringWidth(frag.text, frag.fontName, frag.fontSize)
+				y -= style.leading
+
+	def align_offset(self, alignment, extra_space):
+		if alignment == TA_CENTER:
+			return extra_space / 2.0
+		if alignment == TA_RIGHT:
+			return extra_space
+		return 0
+
+	def layout_chords(self, page, bottom, sizes, row, positions):
+		height = sizes['CHORD_ROW_HEIGHT']
+		left_padding = sizes['MINICHORD_LEFT_PADDING']
+		right_padding = sizes['MINICHORD_RIGHT_PADDING']
+		middle = bottom + (height + sizes['MINICHORD_BOTTOM_PADDING'] - sizes['MINICHORD_TOP_PADDING']) / 2.0
+
+		for (c, (slot_width, chord_sizes)) in enumerate(row.chords):
+			# the chords' slots are centred in the cell, less its padding
+			cell_width = slot_width * len(chord_sizes)
+			x = positions[c] + (row.col_widths[c] + CELL_MARGIN_H - sizes['CHORD_RIGHT_PADDING'] - cell_width) / 2.0
+			avail_width = slot_width - left_padding - right_padding
+			for (chord, fontsize) in chord_sizes:
+				self.layout_cell_text(page, chord, DEFAULT_BOLD_FONT, fontsize, TA_CENTER,
+						x + left_padding, middle, avail_width)
+				x += slot_width
+
+		# the grid round the chords, then the repeat bars over it
+		top = bottom + height
+		border_width = sizes['CHORD_TABLE_BORDER_WIDTH']
+		page.lines.append(LineItem(positions[0], top, positions[-1], top, border_width, CHORD_TABLE_BORDER_COLOR, 1))
+		page.lines.append(LineItem(positions[0], bottom, positions[-1], bottom, border_width, CHORD_TABLE_BORDER_COLOR, 1))
+		for x in positions:
+			page.lines.append(LineItem(x, bottom, x, top, border_width, CHORD_TABLE_BORDER_COLOR, 1))
+		for c in row.start_repeats:
+			page.lines.append(LineItem(positions[c], bottom, positions[c], top, 3*border_width, CHORD_TABLE_BORDER_COLOR, 2))
+		for c in row.end_repeats:
+			page.lines.append(LineItem(positions[c + 1], bottom, positions[c + 1], top, 3*border_width, CHORD_TABLE_BORDER_COLOR, 2))
+
+	def layout_lyrics(self, page, bottom, sizes, row, positions, lnum, lyric_line):
+		height = sizes['LYRIC_ROW_HEIGHT']
+		if lnum % 2 == 0:
+			page.rects.append(RectItem(positions[0], bottom, positions[-1] - positions[0], height, LYRIC_BACK_COLOR))
+
+		middle = bottom + height / 2.0
+		for (c, (lyric_text, fontsize)) in enumerate(lyric_line):
+			self.layout_cell_text(page, lyric_text, LYRIC_FONT, fontsize, TA_LEFT,
+					positions[c] + CELL_MARGIN_H, middle, row.col_widths[c] - 2*CELL_MARGIN_H)
+
+	def layout_cell_text(self, page, text, fontstyle, fontsize, align, x, middle, avail_width):
+		# a fitted cell is one line of a paragraph, middled vertically in the cell
+		text = self.cell_text(text, fontstyle, fontsize, align)
+		if not text:
+			return
+		leading = self.get_fit_style(fontstyle, fontsize, align).leading
+		if align == TA_CENTER:
+			x += (avail_width - text_width(text, fontstyle, fontsize)) / 2.0
+		page.texts.append(TextItem(x, middle + leading / 2.0 - fontsize, text, fontstyle, fontsize))
+
+	def cell_text(self, text, fontstyle, fontsize, align):
+		# what a Paragraph would print: whitespace collapsed and any markup or
+		# entities taken out (markup doesn't change the font here)
+		if '<' not in text and '&' not in text:
+			return ' '.join(text.split())
+		para = Paragraph(text, self.get_fit_style(fontstyle, fontsize, align))
+		para.wrap(self.frame_width, self.frame_top - self.frame_bottom)
+		if para.blPara.kind == 0:
+			return ' '.join(' '.join(words) for (extra_space, words) in para.blPara.lines)
+		return ' '.join(''.join(frag.text for frag in line.words) for line in para.blPara.lines)
+
+#######################################################################################
+# paint
+#######################################################################################
+
+	def paint(self, page):
+		canv = self.canv
+		for (number, title) in page.marks:
+			add_bookmark(canv, number, title)
+
+		# shading under the text, lines on top, as a Table draws them
+		for rect in page.rects:
+			canv.setFillColor(rect.color)
+			canv.rect(rect.x, rect.y, rect.width, rect.height, stroke=0, fill=1)
+
+		canv.setFillColor(colors.black)
+		text = canv.beginText()
+		font = None
+		for item in page.texts:
+			if (item.font, item.size) != font:
+				font = (item.font, item.size)
+				text.setFont(item.font, item.size)
+			text.setTextOrigin(item.x, item.y)
+			text.textOut(item.text)
+		canv.drawText(text)
+
+		stroke = None
+		for line in page.lines:
+			if (line.color, line.width, line.cap) != stroke:
+				stroke = (line.color, line.width, line.cap)
+				canv.setStrokeColor(line.color)
+				canv.setLineWidth(line.width)
+				canv.setLineCap(line.cap)
+			canv.line(line.x1, line.y1, line.x2, line.y2)
+		canv.showPage()
+
+#######################################################################################
+# fitting charts to pages
+#######################################################################################
+
+def page_count_text(pages):
+	return '1 page' if pages == 1 else '%d pages' % pages
+
+# Works out how many pages a chart takes at any scale without rendering it. It
+# records what a renderer would add for the chart once, with the rows of measures
+# left unfitted: where the rows break and how many lyric lines each has doesn't
+# depend on the scale, and their heights don't depend on the text in them. Then
+# for each scale tried it stacks up the heights just as CanvasRenderer's layout
+# (and so platypus) would, which takes a paragraph wrap for each title and
+# section name and some arithmetic, rather than a render.
+class PageFitter(CanvasRenderer):
+
+	def __init__(self):
+		CanvasRenderer.__init__(self)
+		self.set_frame()
+
+	def add_paragraph(self, text, style_name):
+		self.blocks.append(('paragraph', text, style_name))
+
+	def add_spacer(self, name):
+		self.blocks.append(('spacer', name))
+
+	def add_page_break(self):
+		self.blocks.append(None)
+
+	def add_measure_row(self, row):
+		self.blocks.append(('row', len(row.lyrics)))
+
+	def measure_rows(self, data, cols):
+		return self.unfitted_rows(data, cols)
+
+	def flush(self):
+		pass
+
+	def record(self, chart):
+		# what print_metadata and print_measures would add, at no scale in particular
+		self.set_scale(chart.scale)
+		self.blocks = []
+		self.print_metadata(chart)
+		self.print_measures(chart.sections)
+		return self.blocks
+
+	def page_count(self, blocks, scale):
+		# how many pages the blocks take at the scale, or None if something is too
+		# tall for a page
+		self.set_scale(scale)
+		sizes = self.sizes
+		self.elements = []
+		for block in blocks:
+			if block is None:
+				self.elements.append(None)
+			elif block[0] == 'paragraph':
+				self.elements.append((False, [(self.paragraph_height(block[1], self.styles[block[2]]), None, ())]))
+			elif block[0] == 'spacer':
+				self.elements.append((False, [(self.spacers[block[1]].height, None, ())]))
+			else:
+				rows = [(sizes['CHORD_ROW_HEIGHT'], None, ())] + [(sizes['LYRIC_ROW_HEIGHT'], None, ())] * block[1]
+				self.elements.append((True, rows))
+
+		self.page = LayoutPage(1)
+		self.y = self.frame_top
+		try:
+			return 1 + sum(1 for page in self.layout())
+		except ChartError:
+			return None
+
+	def paragraph_height(self, text, style):
+		# plain text with room to spare on its line is a line high; anything
+		# else is wrapped to see
+		words = text.split()
+		if words and '<' not in text and '&' not in text:
+			if text_width(' '.join(words), style.fontName, style.fontSize) + FIT_FUZZ <= self.frame_width:
+				return style.leading
+		para = Paragraph(text, style)
+		return para.wrap(self.frame_width, self.frame_top - self.frame_bottom)[1]
+
+	def fit_steps(self, chart, pages):
+		# The biggest scale, in SCALE_STEPS, at which the chart fits on pages;
+		# None if it fits as it is. Fewer pages don't come from a bigger scale,
+		# so a binary search finds it.
+		blocks = self.record(chart)
+		def fits(scale):
+			count = self.page_count(blocks, scale)
+			return count is not None and count <= pages
+
+		if fits(chart.scale):
+			return None
+		lo = int(ceil(MIN_SCALE * SCALE_STEPS))
+		hi = int(ceil(chart.scale * SCALE_STEPS))
+		if hi <= lo or not fits(lo / SCALE_STEPS):
+			raise ChartError("doesn't fit on %s even at scale %g" % (page_count_text(pages), lo / SCALE_STEPS))
+		# lo fits, hi doesn't
+		while hi - lo > 1:
+			mid = (lo + hi) // 2
+			if fits(mid / SCALE_STEPS):
+				lo = mid
+			else:
+				hi = mid
+		return lo
+
+# the --engine choices
+ENGINES = OrderedDict([('platypus', ChartRenderer), ('canvas', CanvasRenderer)])
+
+def renderer_class(engine):
+	# engine is one of ENGINES, or one of chart_preview.PREVIEWS for a preview
+	if engine in ENGINES:
+		return ENGINES[engine]
+	from chart_preview import PREVIEWS
+	return PREVIEWS[engine]
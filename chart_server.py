@@ -0,0 +1,296 @@
+# Copyright (c) 2016 Bonnie Schulkin. All Rights Reserved.
+#
+# This file is part of box_charts.
+#
+# box_charts is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# box_charts is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with box_charts. If not, see <http://www.gnu.org/licenses/>.
+
+
+#######################################################################################
+# a local HTTP server rendering charts to PDF, for chord_chart.py --serve
+#
+# POST a chart's text to / and the PDF (or the --preview) comes back; ?fit=row and
+# ?fit-pages=N work as the command line options do. The charts are rendered on a
+# pool of worker processes, each with reportlab imported and a renderer warmed up
+# before the server takes its first request. At most workers + queue requests are
+# taken on at once: the rest are turned away with 503 straight away rather than
+# left waiting behind them. A worker that takes longer than RENDER_TIMEOUT over a
+# chart is killed, as is one that dies, and a fresh one takes its place.
+#######################################################################################
+
+import os, sys
+import multiprocessing
+import signal
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue
+from urllib.parse import urlsplit, parse_qs
+
+from chart_parser import ChartError, error_message
+from chart_renderer import FIT_MODES, renderer_class
+
+QUEUE_PER_WORKER = 4 # requests that may wait for a worker, per worker, by default
+MAX_CHART_BYTES = 1024 * 1024 # bigger posts are turned away
+RETRY_AFTER = 1 # seconds, for the requests turned away when the queue is full
+TEXT_TYPE = 'text/plain; charset=utf-8' # of the error messages
+LISTEN_BACKLOG = 128 # connections waiting to be accepted; more are dropped and retried a second later
+RENDER_TIMEOUT = 30 # seconds a worker gets for a chart before it's killed and the client gets 504
+
+# Workers are spawned rather than forked: a forked one would hold copies of the
+# server's ends of every connection, so it would never see the server go and
+# would outlive it, and replacements are started while the server's threads are
+# running, which forking doesn't mix well with.
+WORKER_CONTEXT = multiprocessing.get_context('spawn')
+
+# rendered by each worker before it takes requests: the imports, the styles at
+# scale 1 and the glyph widths of every font a chart uses
+WARM_UP_CHART = '''^Warm Up
+>warming up
+
++Verse~width=4~lyrics=1
+
+G|C Bb|%|:D7
+la la|la|la|la
+
++Chorus~width=2~lyrics=1
+
+Em|F#m7b5:
+la|la
+'''
+
+#######################################################################################
+# workers
+#######################################################################################
+# one renderer per worker process, reused for every chart it's sent
+worker_renderer = None
+
+def run_worker(connection, engine, fit):
+	# renders each (text, fit, fit_pages) sent down the connection and sends
+	# back what render_request makes of it, until the server hangs up
+	global worker_renderer
+	# Ctrl-C is for the server, which stops the workers itself
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	worker_renderer = renderer_class(engine)(fit=fit)
+	worker_renderer.render(WARM_UP_CHART)
+	connection.send(os.getpid())
+	while True:
+		try:
+			request = connection.recv()
+		except EOFError:
+			return
+		connection.send(render_request(*request))
+
+def render_request(text, fit, fit_pages):
+	# (HTTP status, PDF or error message, content type); a bad chart is the
+	# client's problem, anything else is ours
+	worker_renderer.fit = fit
+	worker_renderer.fit_pages = fit_pages
+	try:
+		return (200, worker_renderer.render(text), worker_renderer.content_type)
+	except ChartError as e:
+		return (400, error_message(e), TEXT_TYPE)
+	except Exception as e:
+		return (500, error_message(e), TEXT_TYPE)
+
+# A worker process and the server's end of its connection. Each one renders one
+# chart at a time, so the server knows which chart a worker that hangs or dies
+# was on, and only that chart's client hears about it.
+class Worker:
+
+	def __init__(self, engine, fit):
+		(self.connection, connection) = WORKER_CONTEXT.Pipe()
+		self.process = WORKER_CONTEXT.Process(target=run_worker, args=(connection, engine, fit), daemon=True)
+		self.process.start()
+		connection.close()
+
+	def wait_ready(self):
+		# once it's warmed up; EOFError if it died trying
+		self.connection.recv()
+
+	def render(self, text, fit, fit_pages, timeout):
+		# what render_request makes of the chart; TimeoutError if it takes
+		# too long, EOFError or OSError if the worker's gone
+		self.connection.send((text, fit, fit_pages))
+		if not self.connection.poll(timeout):
+			raise TimeoutError
+		return self.connection.recv()
+
+	def stop(self):
+		self.process.kill()
+		self.process.join()
+		self.connection.close()
+
+#######################################################################################
+# server
+#######################################################################################
+
+class ChartServer(ThreadingHTTPServer):
+
+	request_queue_size = LISTEN_BACKLOG
+
+	def __init__(self, address, workers, queue=None, engine='platypus', fit='cell', fit_pages=None,
+			timeout=RENDER_TIMEOUT):
+		if queue is None:
+			queue = QUEUE_PER_WORKER * workers
+		self.workers = workers
+		self.queue = queue
+		self.engine = engine
+		self.fit = fit
+		self.fit_pages = fit_pages
+		self.render_timeout = timeout
+		self.slots = threading.BoundedSemaphore(workers + queue)
+
+		# the workers are started, and warmed up, before the socket is opened
+		self.running = [Worker(engine, fit) for n in range(workers)]
+		self.running_lock = threading.Lock()
+		self.idle = Queue()
+		try:
+			for worker in self.running:
+				worker.wait_ready()
+				self.idle.put(worker)
+			ThreadingHTTPServer.__init__(self, address, ChartRequestHandler)
+		except:
+			self.stop_workers()
+			raise
+
+	def server_close(self):
+		ThreadingHTTPServer.server_close(self)
+		self.stop_workers()
+
+	def stop_workers(self):
+		with self.running_lock:
+			for worker in self.running:
+				worker.stop()
+			self.running = []
+
+	def replace(self, worker):
+		# a fresh worker for one that's hung or died
+		worker.stop()
+		new_worker = Worker(self.engine, self.fit)
+		with self.running_lock:
+			self.running.remove(worker)
+			self.running.append(new_worker)
+		new_worker.wait_ready()
+		return new_worker
+
+	def render(self, text, fit, fit_pages):
+		# (status, body, content type), or None if there's no room for it
+		if not self.slots.acquire(blocking=False):
+			return None
+		try:
+			worker = self.idle.get()
+			try:
+				return worker.render(text, fit, fit_pages, self.render_timeout)
+			except TimeoutError:
+				worker = self.replace(worker)
+				return (504, "the chart took longer than %d seconds to render" % self.render_timeout, TEXT_TYPE)
+			except (EOFError, OSError):
+				worker = self.replace(worker)
+				return (500, "the worker rendering the chart died", TEXT_TYPE)
+			finally:
+				self.idle.put(worker)
+		finally:
+			self.slots.release()
+
+class ChartRequestHandler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1' # keep connections open between charts
+	disable_nagle_algorithm = True # or the body waits on the ack for the headers
+	server_version = 'box_charts'
+
+	def respond(self, status, body, content_type=TEXT_TYPE, headers=()):
+		if isinstance(body, str):
+			body = (body + '\n').encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for (name, value) in headers:
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def options(self, query):
+		# the server's fit options, or the ones the query string gives
+		params = parse_qs(query)
+		fit = params.get('fit', [self.server.fit])[-1]
+		if fit not in FIT_MODES:
+			raise ValueError("fit must be one of " + ', '.join(FIT_MODES))
+		fit_pages = self.server.fit_pages
+		if 'fit-pages' in params:
+			try:
+				fit_pages = int(params['fit-pages'][-1])
+			except ValueError:
+				fit_pages = 0
+			if fit_pages < 1:
+				raise ValueError("fit-pages must be a number of pages")
+		return (fit, fit_pages)
+
+	def do_GET(self):
+		self.respond(405, "POST a chart to / to render it", headers=[('Allow', 'POST')])
+
+	def do_POST(self):
+		# the whole body is read before anything else is looked at, so that the
+		# connection is ready for the next request whatever's wrong with this one
+		length = self.headers.get('Content-Length')
+		if length is None or not length.isdigit() or int(length) > MAX_CHART_BYTES:
+			self.close_connection = True
+			if length is None or not length.isdigit():
+				self.respond(411, "the chart needs a Content-Length")
+			else:
+				self.respond(413, "charts can be at most %d bytes" % MAX_CHART_BYTES)
+			return
+		body = self.rfile.read(int(length))
+
+		url = urlsplit(self.path)
+		if url.path != '/':
+			self.respond(404, "POST charts to /")
+			return
+		try:
+			(fit, fit_pages) = self.options(url.query)
+			text = body.decode('utf-8')
+		except UnicodeDecodeError:
+			self.respond(400, "the chart has to be UTF-8 text")
+			return
+		except ValueError as e:
+			self.respond(400, str(e))
+			return
+
+		result = self.server.render(text, fit, fit_pages)
+		if result is None:
+			self.respond(503, "too busy; try again", headers=[('Retry-After', str(RETRY_AFTER))])
+		else:
+			self.respond(*result)
+
+	def log_request(self, code='-', size='-'):
+		# only what went wrong: a line per chart rendered, or turned away
+		# when the queue's full, is no use under load
+		if isinstance(code, int) and code >= 400 and code != 503:
+			BaseHTTPRequestHandler.log_request(self, code, size)
+
+#######################################################################################
+# MAIN
+#######################################################################################
+
+def serve(address, workers, queue=None, engine='platypus', fit='cell', fit_pages=None):
+	# address is (host, port); port 0 picks a free one
+	server = ChartServer(address, workers, queue, engine, fit, fit_pages)
+	(host, port) = server.server_address[:2]
+	print("serving charts on http://%s:%d/ with %d workers, %d more queued (Ctrl-C to stop)" % (
+			host, port, server.workers, server.queue))
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
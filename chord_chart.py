@@ -20,666 +20,514 @@
 # imports
 #######################################################################################
 
-from reportlab.pdfgen import canvas
-from reportlab.lib import colors
-from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Frame, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY
-from reportlab.pdfbase.pdfmetrics import stringWidth 
-from reportlab.lib.utils import simpleSplit 
-from reportlab.platypus.paragraph import ParaLines, FragLine
-# http://www.reportlab.com/apis/reportlab/2.4/platypus.html
-
 import os, sys
-from math import floor
 import time
+import argparse
+import hashlib
+import json
+from collections import namedtuple
+from functools import partial
+
+import chart_parser
+from chart_parser import (ChartError, KEY_CHANGE_START, PDF_DIR, SCALE_DEGREES, SCALE_START,
+		error_message, parse_cache_dir, parse_lines, read_chart)
 
 #######################################################################################
 # constants
 #######################################################################################
-# scaled constants to be set later in set_scaled_constants
-SECTION_START = '+'
-MEASURE_SPLIT = '|'
-SECTION_LINE_SPLIT = '~'
-TITLE_START = '^'
-METADATA_START = '>'
-REPEAT_CHAR = ':'
-SCALE_START = '*'
-KEY_CHANGE_START = '}'
-KEY_CHANGE_SPLIT = '~'
-
-DEFAULT_FONT = 'Helvetica'
-DEFAULT_BOLD_FONT = 'Helvetica-Bold'
-LYRIC_FONT = DEFAULT_FONT
-
-CHORD_TABLE_BORDER_COLOR = colors.black
-LYRIC_BACK_COLOR = colors.Color(.75,.75,.75,1) # light gray
-
-TOP_MARGIN = 0.25*inch
-LEFT_MARGIN = 0.75*inch
+ENGINE_NAMES = ('platypus', 'canvas') # the --engine choices, as in chart_renderer.ENGINES
+FIT_MODE_NAMES = ('cell', 'row', 'section') # the --fit choices, as in chart_renderer.FIT_MODES
+PREVIEW_NAMES = ('svg', 'html') # the --preview choices, as in chart_preview.PREVIEWS
 
-CELL_MARGIN_H = 6 # default
-CELL_MARGIN_V = 3 # default
-
-DEBUG = False
-
-PDF_DIR = 'pdf'
 TEXT_DIR = 'text'
+CHART_EXT = '.txt'
+RENDER_CACHE_FILE = '.render_cache.json'
+WATCH_INTERVAL = 0.2 # seconds between looks at the charts for --watch
+DEFAULT_HOST = '127.0.0.1' # what --serve listens on without a host
 
-SCALE_DEGREES = {}
-SCALE_DEGREES['Ab'] = ['Ab', 'Bb', 'C', 'Db', 'Eb', 'F', 'G']
-SCALE_DEGREES['A'] = ['A', 'B', 'C#', 'D', 'E', 'F#', 'G#']
-SCALE_DEGREES['Bb'] = ['Bb', 'C', 'D', 'Eb', 'F', 'G', 'A']
-SCALE_DEGREES['B'] = ['B', 'C#', 'D#', 'E', 'F#', 'G#', 'A#']
-SCALE_DEGREES['C'] = ['C', 'D', 'E', 'F', 'G', 'A', 'B']
-SCALE_DEGREES['Db'] = ['Db', 'Eb', 'F', 'Gb', 'Ab', 'Bb', 'C']
-SCALE_DEGREES['D'] = ['D', 'E', 'F#', 'G', 'A', 'B', 'C#']
-SCALE_DEGREES['Eb'] = ['Eb', 'F', 'G', 'Ab', 'Bb', 'C', 'D']
-SCALE_DEGREES['E'] = ['E', 'F#', 'G#', 'A', 'B', 'C#', 'D#']
-SCALE_DEGREES['F'] = ['F', 'G', 'A', 'Bb', 'C', 'D', 'E']
-SCALE_DEGREES['F#'] = ['F#', 'G#', 'A#', 'B', 'C#', 'D#', 'E#']
-SCALE_DEGREES['G'] = ['G', 'A', 'B', 'C', 'D', 'E', 'F#']
-
-#######################################################################################
-# globals
-#######################################################################################
-global doc, dwidth, dheight, elements, styles, sizes, spacers
+# part of every render cache key; bump it whenever a change alters the PDFs
+RENDERER_VERSION = '2'
 
 #######################################################################################
-# pdf styles
+# batch rendering
 #######################################################################################
-
-def create_styles():
-
-	global styles
-	
-	# paragraph styes
-	styles = getSampleStyleSheet()
-	styles.add(ParagraphStyle(
-			'title_text',
-			fontName=DEFAULT_BOLD_FONT, 
-			fontSize=sizes['TITLE_FONT_SIZE'],
-			alignment=TA_CENTER))
-	styles.add(ParagraphStyle(
-			'mdata_text',
-			fontName=DEFAULT_FONT, 
-			fontSize=sizes['MDATA_FONT_SIZE'],
-			alignment=TA_CENTER))
-	styles.add(ParagraphStyle(
-			'section_header_text',
-			fontName=DEFAULT_BOLD_FONT, 
-			fontSize=sizes['SECTION_FONT_SIZE'],
-			alignment=TA_LEFT))
-	styles.add(ParagraphStyle(
-			'chord_text',
-			fontName=DEFAULT_BOLD_FONT, 
-			fontSize=sizes['CHORD_FONT_SIZE'],
-			alignment=TA_CENTER))
-	styles.add(ParagraphStyle(
-			'lyric_text',
-			fontName=LYRIC_FONT, 
-			fontSize=sizes['LYRIC_FONT_SIZE'],
-			alignment=TA_LEFT))
-
-def create_spacers():
-
-	global spacers
-	spacers = {}
-	
-	spacers['section_title'] = Spacer(1, sizes['MDATA_FONT_SIZE']/2)
-	spacers['section'] = Spacer(1, sizes['TABLE_SPACER_SIZE'])
-	spacers['title'] = Spacer(1, scale_it(0.8*sizes['TITLE_FONT_SIZE'])) # double scale
-	spacers['mdata'] = Spacer(1, scale_it(sizes['MDATA_FONT_SIZE'])) # double scale
-	spacers['post_chord-lyric'] = Spacer(0,sizes['LYRIC_FONT_SIZE'])
-
-#######################################################################################
-# functions  
-#######################################################################################
-
-def set_scaled_constants():
-
-	global sizes
-	sizes = {}
-	
-	sizes['TITLE_FONT_SIZE'] = scale_it(24)
-	sizes['MDATA_FONT_SIZE'] = scale_it(12)
-	sizes['CHORD_FONT_SIZE'] = scale_it(16)
-	sizes['LYRIC_FONT_SIZE'] = scale_it(11)
-	sizes['SECTION_FONT_SIZE'] = scale_it(14)
-
-	sizes['CHORD_TABLE_BORDER_WIDTH'] = scale_it(1)
-
-	sizes['LYRIC_ROW_HEIGHT'] = sizes['LYRIC_FONT_SIZE'] * 1.2
-	sizes['CHORD_ROW_HEIGHT'] = sizes['CHORD_FONT_SIZE'] * 2
-	sizes['CHORD_RIGHT_PADDING'] = sizes['CHORD_FONT_SIZE']/1.6
-
-	sizes['TABLE_SPACER_SIZE'] = scale_it(20)
-
-	# for multi-chord cells
-	sizes['MINICHORD_RIGHT_PADDING'] = scale_it(0)
-	sizes['MINICHORD_LEFT_PADDING'] = scale_it(0)
-	sizes['MINICHORD_BOTTOM_PADDING'] = sizes['CHORD_FONT_SIZE']/1.6 
-	sizes['MINICHORD_TOP_PADDING'] = scale_it(0)
-	sizes['MINICHORD_TABLE_STYLE'] = [
-	# 				('GRID', (0,0), (-1,-1), 1, colors.black),
-					('ALIGN', (0, 0), (-1,-1), 'CENTER'),
-					('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-					('LEFTPADDING', (0,0), (-1,-1), sizes['MINICHORD_LEFT_PADDING']),
-					('RIGHTPADDING', (0,0), (-1,-1), sizes['MINICHORD_RIGHT_PADDING']),
-					('BOTTOMPADDING', (0,0), (-1,-1), sizes['MINICHORD_BOTTOM_PADDING']),
-					('TOPPADDING', (0,0), (-1,-1), sizes['MINICHORD_TOP_PADDING'])
-					]
-
-def print_debug(string):
-	if debug:
-		print(string)
-
-def get_list(filename): 
-	scriptDir = os.path.dirname(os.path.realpath(__file__))
-	with open(os.path.join(scriptDir, filename)) as f:
-		lines = f.read()
-	f.close()
-	return lines.split('\n')
-
-def measure_split(line, chords):
-	l = line
-	if chords:
-		l = line.strip(MEASURE_SPLIT)
-	return l.split(MEASURE_SPLIT)
-
-def get_col_array(colcount, total_colcount):
-	colwidth = (dwidth - 2*LEFT_MARGIN) / total_colcount
-	return (colwidth, [colwidth] * colcount)
-
-def initialize_rows(rowcount):
-	r = {}
-	for rownum in range(rowcount):
-		r[rownum] = []
-	return r
-
-def get_lyric_lines(lyric_array, measure_start, column_count):
-	# do we need to print all the lyrics rows? 
-	lyric_total = 0
-	lyric_count = len(lyric_array)
-	
-	# test each line individually, backward
-	for n in range(1, lyric_count + 1):
-		lyric_line = lyric_count + 1 - n
-		for column in range(column_count):
-			lyricblob = ''.join(lyric_array[lyric_line][measure_start:measure_start + column_count])
-			if lyricblob != '':
-				return lyric_line
-
-	# if we got this far, no lines are good
-	return 0
-
-def get_cols(chord_array, measure_number, col_count, default_col_array):
-	# will there be an incomplete line? 
-	hanging_line = len(chord_array) % col_count
-
-	# short last line? 
-	if hanging_line and len(chord_array) - measure_number < col_count:
-		this_col_count = len(chord_array) % col_count
-		(this_width, this_col_array) = get_col_array(this_col_count, col_count)
+# one renderer per process, so styles carry over from chart to chart
+renderer = None
+
+# what render_job reports for each chart; cached means it was already up to date
+RenderResult = namedtuple('RenderResult', 'filename pdf_files seconds error fit_cache cached')
+
+def renderer_class(engine):
+	# engine is one of ENGINE_NAMES, or PREVIEW_NAMES for a preview
+	import chart_renderer
+	return chart_renderer.renderer_class(engine)
+
+def get_renderer(engine='platypus', fit='cell', fit_pages=None):
+	# made the first time it's needed, which is when reportlab gets imported
+	global renderer
+	if type(renderer) is not renderer_class(engine):
+		renderer = renderer_class(engine)(parse_cache_dir())
+	renderer.fit = fit
+	renderer.fit_pages = fit_pages
+	return renderer
+
+def render_chart(filename, keys=None, from_key=None, engine='platypus', fit='cell', fit_pages=None):
+	return get_renderer(engine, fit, fit_pages).render_file(filename, PDF_DIR, keys, from_key)
+
+def render_stdio(profile=None, engine='platypus', fit='cell', fit_pages=None):
+	# chart on stdin, PDF on stdout, nothing written to disk
+	try:
+		renderer_class(engine)(profile=profile, fit=fit, fit_pages=fit_pages).render(sys.stdin, sys.stdout.buffer)
+	except ChartError as e:
+		sys.stderr.write("<stdin>: " + error_message(e) + "\n")
+		sys.exit(1)
+
+def render_job(filename, keys=None, from_key=None, engine='platypus', fit='cell', fit_pages=None):
+	# render one chart, reporting failure instead of raising so that
+	# one bad chart doesn't take the rest of the batch down with it
+	from chart_renderer import fit_cache_info
+	start = time.perf_counter()
+	cache_start = fit_cache_info()
+	pdf_files = []
+	error = None
+	try:
+		pdf_files = render_chart(filename, keys, from_key, engine, fit, fit_pages)
+	except Exception as e:
+		error = error_message(e)
+
+	cache_end = fit_cache_info()
+	fit_cache = (cache_end.hits - cache_start.hits, cache_end.misses - cache_start.misses)
+
+	return RenderResult(filename, pdf_files, time.perf_counter() - start, error, fit_cache, False)
+
+def render_all(filenames, jobs, cache=None, keys=None, from_key=None, engine='platypus', fit='cell', fit_pages=None):
+	results = {}
+	digests = {}
+	todo = []
+	options = [','.join(keys or []), from_key or '', engine, fit, str(fit_pages or '')]
+
+	# charts whose PDFs are already up to date don't need rendering again
+	for filename in filenames:
+		if cache is not None:
+			try:
+				digests[filename] = chart_hash(read_chart(filename), options)
+			except OSError:
+				# leave it to render_job to report
+				todo.append(filename)
+				continue
+			pdf_files = cache.lookup(filename, digests[filename])
+			if pdf_files:
+				results[filename] = RenderResult(filename, pdf_files, 0.0, None, (0, 0), True)
+				continue
+		todo.append(filename)
+
+	job = partial(render_job, keys=keys, from_key=from_key, engine=engine, fit=fit, fit_pages=fit_pages)
+	if jobs == 1 or len(todo) <= 1:
+		rendered = [job(filename) for filename in todo]
 	else:
-		this_col_count = col_count
-		this_col_array = default_col_array
-		
-	return (this_col_count, this_col_array)
-
-def scale_it(number):
-	return scale * number
-
-def create_paragraph(texttype, input_text, fontsize, fontstyle, maxwidth, align):
-
-# 	if texttype == 'lyric' or len(input_text) <= 1: 
-# 		text = input_text
-#   		small_fontsize = fontsize
-# 	else:
-# 		text = input_text[0]
-# 		small_fontsize = str(fontsize*0.7)
-# 		for i in range(1,len(input_text)):
-# 			if input_text[i] in ['#', 'b']:
-# 				text += '<super>' + input_text[i] + '</super>'
-# 			else:
-# 				text += input_text[i]
-# 	
-# 	if '<super>' in text:
-# 		print text
-
-	text = input_text
-		
-	text_width = stringWidth(text, fontstyle, fontsize)
-	new_fontsize = fontsize
-	line_count = len(simpleSplit(text, fontstyle, new_fontsize, maxwidth)) 
-
-	while (line_count > 1 or text_width > maxwidth) and new_fontsize > 0: 
-
-		new_fontsize = new_fontsize - scale_it(0.5)
-		text_width = stringWidth(text, fontstyle, new_fontsize)
-		line_count = len(simpleSplit(text, fontstyle, new_fontsize, maxwidth)) 
-	
-# 	if text == 'something from the':
-# 		print "text width: " + str(text_width) + " font size: " + str(fontsize)
-	
-	if fontsize <= 0:
-		print("error: can't print this " + texttype + ": [" + text + "] too wide at any size. Exiting.")
-		exit()
-
-	# make a new style based on this new size
-	uniq = str(time.time())
-	style_name = texttype + uniq
-	styles.add(ParagraphStyle(
-			style_name,
-			fontName=fontstyle,
-			fontSize=new_fontsize,
-			alignment=align))
-
-	return Paragraph(text, styles[style_name])
+		import multiprocessing
+		with multiprocessing.Pool(jobs) as pool:
+			rendered = pool.map(job, todo, chunksize=1)
+
+	for result in rendered:
+		results[result.filename] = result
+		if cache is not None and not result.error and result.filename in digests:
+			cache.store(result.filename, digests[result.filename], result.pdf_files)
+
+	if cache is not None:
+		cache.save()
+
+	return [results[filename] for filename in filenames]
+
+def render_songbook_files(filenames, output, contents=False, engine='platypus', fit='cell'):
+	# all the charts in one PDF; returns (filename, error) for every chart left out
+	renderer = get_renderer(engine, fit)
+
+	charts = []
+	chart_files = []
+	failures = []
+	for filename in filenames:
+		try:
+			with renderer.stage('parse'):
+				charts.append(renderer.parse_cache.parse(read_chart(filename)))
+			chart_files.append(filename)
+		except Exception as e:
+			failures.append((filename, error_message(e)))
+
+	errors = renderer.render_songbook(charts, output, contents)
+	failures.extend((chart_files[n], error) for (n, error) in sorted(errors.items()))
+	return failures
+
+def render_songbook_report(filenames, output, contents=False, engine='platypus', fit='cell'):
+	# render_songbook_files, printing what happened; returns whether every chart made it
+	start = time.perf_counter()
+	failures = render_songbook_files(filenames, output, contents, engine, fit)
+	for (filename, error) in failures:
+		print(filename + ": " + error)
+	print("%8.3fs  %d of %d charts -> %s" % (time.perf_counter() - start,
+			len(filenames) - len(failures), len(filenames), output))
+	return not failures
+
+def get_chart_files(args):
+	# expand any directories into the chart files they contain
+	filenames = []
+	for arg in args:
+		if os.path.isdir(arg):
+			for name in sorted(os.listdir(arg)):
+				if name.endswith(CHART_EXT):
+					filenames.append(os.path.join(arg, name))
+		else:
+			filenames.append(arg)
+	return filenames
+
+def parse_keys(arg):
+	if arg == 'all':
+		return sorted(SCALE_DEGREES)
+	keys = arg.split(',')
+	for key in keys:
+		if key not in SCALE_DEGREES:
+			raise argparse.ArgumentTypeError("unknown key: " + key)
+	return keys
+
+def parse_address(arg):
+	# [HOST:]PORT for --serve
+	(host, sep, port) = arg.rpartition(':')
+	if not port.isdigit() or int(port) > 65535:
+		raise argparse.ArgumentTypeError("not a [host:]port: " + arg)
+	return (host or DEFAULT_HOST, int(port))
+
+def print_result(result):
+	if result.error:
+		print("%8.3fs  %s FAILED: %s" % (result.seconds, result.filename, result.error))
+	elif result.cached:
+		print("%9s  %s -> %s" % ('cached', result.filename, ', '.join(result.pdf_files)))
+	else:
+		print("%8.3fs  %s -> %s" % (result.seconds, result.filename, ', '.join(result.pdf_files)))
+
+def print_timings(results, wall):
+	total = 0
+	hits = 0
+	misses = 0
+	up_to_date = 0
+	for result in results:
+		print_result(result)
+		if result.cached:
+			up_to_date += 1
+		total += result.seconds
+		hits += result.fit_cache[0]
+		misses += result.fit_cache[1]
+	print("%8.3fs  total for %d charts (%.3fs wall)" % (total, len(results), wall))
+	if up_to_date:
+		print("render cache: %d up to date, %d rendered" % (up_to_date, len(results) - up_to_date))
+	if hits + misses:
+		print("fit cache: %d hits, %d misses (%.1f%% hit rate)" % (hits, misses, 100.0 * hits / (hits + misses)))
 
 #######################################################################################
-# create_table
+# checking
 #######################################################################################
 
-def create_table(data, cols, mnum): 
-#  	tstyles_start = [('VALIGN', (0,0), (-1,-1), 'MIDDLE')]
-	tstyles_start = [('VALIGN', (0,0), (-1,-1), 'MIDDLE'), ('ALIGN', (0, 0), (-1,-1), 'CENTER')]
-
-	# get col width and make an array for the table
-	(col_width, col_array) = get_col_array(cols, cols)
-
-	# for easier future reference
-	chords = data['chords']
-	lyrics = data['lyrics']
-
-	# initialize rows
-	rows = initialize_rows(len(lyrics) + 1)
-
-	# initialize column count and lyric lines for the first go-around
-	(this_col_count, this_col_array) = get_cols(chords, 0, cols, col_array)
-	lyric_total = get_lyric_lines(lyrics, 0, this_col_count)
-	row_count = lyric_total + 1 
-	col_counter = 0
-	# track repeat measures
-	start_repeat_measures = []
-	end_repeat_measures = []
-
-	# process the data
-	for i in range(len(chords)):
-
-		rnum = int(floor (i / cols))
-		cnum = col_counter
-# 		print "i" + str(i) + " rnum" + str(rnum) + " cnum" + str(cnum)
-		
-		# look for repeats
-		chord_text = chords[i]
-		if chord_text[0] == REPEAT_CHAR:
-			start_repeat_measures.append(cnum)
-			chord_text = chord_text[1:]
-		elif chord_text[-1] == REPEAT_CHAR:
-			end_repeat_measures.append(cnum)
-			chord_text = chord_text[:-1]
-		
-		# make a mini table to contain the multi-chords
-		chord_list = chord_text.split(' ')
-		chordnum = len(chord_list)	
-		
-		mini_table_data = []
-		for chd in chord_list:
-			chord_width = (col_width - sizes['CHORD_RIGHT_PADDING'])/chordnum
-			avail_width = chord_width - sizes['MINICHORD_RIGHT_PADDING'] - sizes['MINICHORD_LEFT_PADDING']
-			chord_para = create_paragraph('chord', chd, sizes['CHORD_FONT_SIZE'], DEFAULT_BOLD_FONT, avail_width, TA_CENTER)
-			mini_table_data.append(chord_para)
-# 			http://www.reportlab.com/apis/reportlab/2.4/platypus.html
-
-		rows[0].append(Table([mini_table_data], 
-								colWidths=[chord_width]*chordnum, 
-								rowHeights=[sizes['CHORD_ROW_HEIGHT']], 
-								style=sizes['MINICHORD_TABLE_STYLE'], 
-								hAlign='CENTER'))
-# 		rows[0].append(Paragraph(','.join([str(cnum),str(rnum)]), styles['chord_text']))
-
-		# then the lyrics
-		for l in range(1,row_count):
-			if i >= len(lyrics[l]):
-				lyric_text = ''
+def check_chart(filename):
+	# every error the parser finds in the chart, without rendering anything
+	try:
+		text = read_chart(filename)
+	except OSError as e:
+		return [ChartError(e.strerror or str(e))]
+
+	errors = []
+	try:
+		chart = parse_lines(text.split('\n'), errors)
+	except Exception as e:
+		# a bug in the parser rather than the chart, but still worth hearing about
+		errors.append(ChartError(error_message(e)))
+		return errors
+	if chart.title is None:
+		errors.append(ChartError("chart has no title line"))
+	return errors
+
+def check_all(filenames):
+	# prints every error in the charts, compiler style; returns how many there were
+	start = time.perf_counter()
+	error_count = 0
+	bad_charts = 0
+	for filename in filenames:
+		errors = check_chart(filename)
+		for e in errors:
+			if e.line is None:
+				print("%s: %s" % (filename, e))
 			else:
-				lyric_text = lyrics[l][i]
-
-			# is it too wide? Get the right font size
-			this_lyric_para = create_paragraph('lyric', lyric_text, sizes['LYRIC_FONT_SIZE'], LYRIC_FONT, col_width - 2*CELL_MARGIN_H, TA_LEFT)
-			rows[l].append(this_lyric_para)
-
-		# increment column counter
-		col_counter += 1
-
-		# time to draw the measure row? 
-		if col_counter == this_col_count:
-				
-			tdata = []
-			tstyles = []
-			tstyles += tstyles_start # can't just say tstyles = tstyles_start; tstyles_start starts changin'
-			
-			# row heights
-			rheights = [sizes['CHORD_ROW_HEIGHT']] + [sizes['LYRIC_ROW_HEIGHT']] * lyric_total
-
-			# chords style
-			tstyles.append(('GRID', (0, 0), (this_col_count - 1, 0), sizes['CHORD_TABLE_BORDER_WIDTH'],CHORD_TABLE_BORDER_COLOR))
-			tstyles.append(('RIGHTPADDING', (0, 0), (this_col_count - 1, 0), sizes['CHORD_RIGHT_PADDING']))
-
-			# lyrics shading every other row
-			for lnum in range(1,row_count):
-				if lnum % 2 == 0:				
-					tstyles.append(('BACKGROUND', (0, lnum), (this_col_count - 1, lnum), LYRIC_BACK_COLOR))
-
-			# repeat measures
-			#line commands are like 
-			#op, start, stop, weight, colour, cap, dashes, join, linecount, linespacing 
-			for coord in start_repeat_measures:
-				tstyles.append(('LINEBEFORE', (coord,0), (coord,0), 3*sizes['CHORD_TABLE_BORDER_WIDTH'], CHORD_TABLE_BORDER_COLOR, 2))
-# 				tstyles.append(('LINEBEFORE', (coord,0), (coord,0), 3*sizes['CHORD_TABLE_BORDER_WIDTH'], CHORD_TABLE_BORDER_COLOR, 2, [], 2, 2, 3*sizes['CHORD_TABLE_BORDER_WIDTH']))
-			for coord in end_repeat_measures:
-				tstyles.append(('LINEAFTER', (coord,0), (coord,0), 3*sizes['CHORD_TABLE_BORDER_WIDTH'], CHORD_TABLE_BORDER_COLOR, 2))
-
-			# add rows to the table data
-			for r in range(row_count):
-				tdata.append(rows[r]) 
-			
-			elements.append(Table(tdata, 
-									colWidths=this_col_array, 
-									rowHeights=rheights, 
-									style=tstyles, 
-									hAlign='LEFT'))
-			elements.append(spacers['post_chord-lyric'])
-	
-			# re-initialize rows
-			rows = initialize_rows(len(lyrics) + 1)
-
-			# re-initialize column count and lyric lines for the next go-around
-			(this_col_count, this_col_array) = get_cols(chords, i+1, cols, col_array)
-			lyric_total = get_lyric_lines(lyrics, i+1, this_col_count)
-			row_count = lyric_total + 1 
-			col_counter = 0
-			start_repeat_measures = []
-			end_repeat_measures = []
-
-# 			if rnum == 4:
-# 				print i + 1
-# 				print "thi_cols" + str(this_col_count)
-# 				print "lyric_total" + str(lyric_total)
+				print("%s:%d: %s" % (filename, e.line, e))
+		error_count += len(errors)
+		bad_charts += bool(errors)
 
-#######################################################################################
-# start pdf
-#######################################################################################
-def start_pdf(mdata):
-	global doc, elements, dwidth, dheight
-
-	pdf_file = os.path.join(PDF_DIR, mdata['title'] + '.pdf')
-	doc = SimpleDocTemplate(pdf_file, pagesize=letter)
-	elements = []
-	dwidth, dheight = letter
-
-	# margins
-	doc.topMargin = TOP_MARGIN
-	doc.leftMargin = LEFT_MARGIN
-	doc.bottomMargin = TOP_MARGIN
-	doc.rightMargin = LEFT_MARGIN
-	
-def transpose(key1, key2, raw_chord):
-	scale1 = SCALE_DEGREES[key1]
-	scale2 = SCALE_DEGREES[key2]
-	
-	if raw_chord in ['%', '']:
-		return(raw_chord)
-		
-	after_stuff = ''
-	before_stuff = ''
-	if raw_chord[0] == REPEAT_CHAR:
-		before_stuff = REPEAT_CHAR
-		chord = raw_chord[1:]
+	seconds = time.perf_counter() - start
+	if error_count:
+		print("%d errors in %d of %d charts (%.3fs)" % (error_count, bad_charts, len(filenames), seconds))
 	else:
-		chord = raw_chord	
-	
-	# find the scale degree
-	if chord in scale1:
-		index = scale1.index(chord)
-	elif chord[0:2] in scale1:
-		index = scale1.index(chord[0:2])
-		after_stuff = chord[2:]
-	elif chord[0] in scale1:
-		index = scale1.index(chord[0])
-		after_stuff = chord[1:]
-	elif chord[0] + '#' in scale1:
-		index = scale1.index(chord[0] + '#')
-		after_stuff = '#' + chord[1:]
-	elif chord[0] + 'b' in scale1:
-		index = scale1.index(chord[0] + 'b')
-		after_stuff = 'b' + chord[1:]
-	else:
-		print("bad chord: [" + chord + "]. Exiting.")
-		exit()
-	
-	# translate it to the new key
-	new_chord = before_stuff + scale2[index] + after_stuff
-	
-	# eliminate nonsense like b# or #b
-	new_chord = new_chord.replace('b#', '')
-	new_chord = new_chord.replace('#b', '')
-	
-	return new_chord
-	
-def transpose_list(key1, key2, old_chords):
-	if key1 == '':
-		return old_chords
-		
-	new_chords = []
-	for raw_chord in old_chords:
-		if ' ' in raw_chord:
-			new_chord = ' '.join(transpose_list(key1, key2, raw_chord.split(' ')))
-		elif '/' in raw_chord:
-			new_chord = '/'.join(transpose_list(key1, key2, raw_chord.split('/')))			
-		else:
-			new_chord = transpose(key1, key2, raw_chord)
-		
-		new_chords.append(new_chord)
-		
-	return new_chords
+		print("%d charts OK (%.3fs)" % (len(filenames), seconds))
+	return error_count
 
 #######################################################################################
-# parse file
+# watching
 #######################################################################################
 
-def parse_file(data_file):
-
-	global scale
-	sections = {}
-	mdata = {}
-	new_measure = False
-	lyrics_line_next = False
-	snum = 0
-	lnum = 1
-	first_measure = True
-	scale = 1
-	from_key = ''
-	to_key = ''
-
-	for line in get_list(data_file):
-		# new measure line
-		if line == '':
-			new_measure = True
-			lyrics_line_next = False
-	# 		print("blank line: [" + line + "]")
-		
-		# title line
-		elif line[0] == TITLE_START:	
-			mdata['title'] = line[1:]
-
-		#  metadata line
-		elif line[0] == METADATA_START:
-			if 'other' not in mdata:
-				mdata['other'] = []			
-			mdata['other'].append(line[1:])
-	
-		elif line[0] == SCALE_START:
-			scale = float(line[7:])
-
-		elif line[0] == KEY_CHANGE_START:
-			from_key, to_key = line[1:].split(KEY_CHANGE_SPLIT)
-
-		# new section
-		elif line[0] == SECTION_START:
-	# 		print("section line: [" + line + "]")
-			snum = snum + 1
-			sections[snum] = {}
-			sections[snum]['measures'] = {}
-			sections[snum]['measures']['chords'] = []
-
-			if SECTION_LINE_SPLIT in line:
-				tokens = line[1:].split(SECTION_LINE_SPLIT)
-				sections[snum]['name'] = tokens[0]
-		
-			if len(tokens) > 1:
-				for item in tokens[1:]:
-					if '=' not in item:
-						print("Bad section line [" + line + "]. Exiting.")
-						exit()
-					(key, val) = item.split('=')
-					if key == 'width':
-						width = int(val)
-						sections[snum]['width'] = width
-					elif key == 'lyrics':
-						lcount = int(val)
-						sections[snum]['lcount'] = lcount
-					elif key == 'pickup':
-						sections[snum]['pickup'] = int(val)
-					else:
-						print("Bad section data: [" + item + "]. Exiting.")
-						exit()
-			
-			else:
-				sections[snum]['name'] = ''
-				print_debug('WARNING: section ' + str(snum) + ' has no name')
-
-			new_measure = True
-			first_measure = True
-			lyrics_line_next = False
-		
-		# measure line
-		elif new_measure:
-	# 		print("measure first line: [" + line + "]")
-
-			if first_measure:
-				first_measure = False
-			else:
-			# clean up from previous measure
-				while lcount >= lnum:
-					if lnum not in sections[snum]['measures']['lyrics']:
-						sections[snum]['measures']['lyrics'][lnum] = []
-					sections[snum]['measures']['lyrics'][lnum] += [''] * width
-					lnum += 1
-		
-			raw_chords = measure_split(line, chords=True)
-			chords = transpose_list(from_key, to_key, raw_chords)
-			sections[snum]['measures']['chords'] += chords
-			linelength = len(chords)
-			new_measure = False
-			lyrics_line_next = True
-			lnum = 1
-		
-		# lyrics line
-		elif lyrics_line_next:
-	# 		print("lyrics line: [" + line + "]")
-			lyrics = measure_split(line, chords=False)
-			if len(lyrics) > linelength:
-				print("lyrics line [" + line + "] has too many measures. Exiting.")
-				exit()
-		
-			while len(lyrics) < linelength:
-				lyrics.append('')
-		
-			if 'lyrics' not in sections[snum]['measures']:
-				sections[snum]['measures']['lyrics'] = {}
-			if lnum not in sections[snum]['measures']['lyrics']:
-				sections[snum]['measures']['lyrics'][lnum] = []
-			sections[snum]['measures']['lyrics'][lnum] += lyrics
-			lnum += 1
-		
-		# should never get here
-		else: 
-			print("bad line: [" + line + "]. Exiting.")
-			exit()
-
-	return (mdata, sections)
+def chart_stamps(args):
+	# the charts args name, with their modification time and size; directories
+	# are looked through again each time so that new charts are seen
+	stamps = {}
+	for filename in get_chart_files(args):
+		try:
+			stat = os.stat(filename)
+		except OSError:
+			# gone, or being saved; it'll count as changed when it's back
+			continue
+		stamps[filename] = (stat.st_mtime_ns, stat.st_size)
+	return stamps
+
+def watch_charts(args, render, interval=WATCH_INTERVAL):
+	# polls the charts, calling render with the ones that are new or changed,
+	# until interrupted
+	stamps = chart_stamps(args)
+	try:
+		while True:
+			time.sleep(interval)
+			new_stamps = chart_stamps(args)
+			changed = sorted(filename for (filename, stamp) in new_stamps.items() if stamps.get(filename) != stamp)
+			stamps = new_stamps
+			if changed:
+				render(changed)
+	except KeyboardInterrupt:
+		pass
 
 #######################################################################################
-# print metadata 
+# render cache
 #######################################################################################
-def print_metadata(mdata):
-	# title
-	if len(mdata) > 0: 
-		if 'title' in mdata:
-			elements.append(Paragraph(mdata['title'], styles['title_text']))
-		else:
-			print_debug("WARNING: no title")
 
-		if 'other' in mdata:
-			elements.append(spacers['title'])
-			for line in mdata['other']:
-				elements.append(Paragraph(line, styles['mdata_text']))
-				elements.append(spacers['mdata'])
+def chart_hash(text, options=()):
+	# everything that decides what the PDFs look like: the chart itself, its
+	# scale and key change lines, the version of the renderer drawing it and
+	# any options it's drawn with (like the keys to transpose to)
+	directives = [line for line in text.split('\n') if line[:1] in (SCALE_START, KEY_CHANGE_START)]
+	digest = hashlib.sha1()
+	for part in [RENDERER_VERSION] + list(options) + directives + [text]:
+		digest.update(part.encode('utf-8'))
+		digest.update(b'\0')
+	return digest.hexdigest()
+
+# Remembers, per chart file, the hash of the chart that was last rendered and the
+# PDFs it went to, in a JSON file alongside the PDFs. A chart is up to date if its
+# hash hasn't changed and its PDFs are still the ones we wrote (charts sharing a
+# title write the same PDF, so each PDF's size and mtime are checked too).
+class RenderCache:
+
+	def __init__(self, pdf_dir):
+		self.path = os.path.join(pdf_dir, RENDER_CACHE_FILE)
+		self.entries = {}
+		if os.path.exists(self.path):
+			try:
+				with open(self.path) as f:
+					self.entries = json.load(f)
+			except ValueError:
+				# a corrupt cache just means rendering everything again
+				self.entries = {}
+
+	def lookup(self, filename, digest):
+		entry = self.entries.get(os.path.abspath(filename))
+		if entry is None or entry.get('hash') != digest:
+			return None
+		for (pdf_file, pdf_stat) in zip(entry['pdfs'], entry['stats']):
+			try:
+				stat = os.stat(pdf_file)
+			except OSError:
+				return None
+			if [stat.st_size, stat.st_mtime] != pdf_stat:
+				return None
+		return entry['pdfs']
+
+	def store(self, filename, digest, pdf_files):
+		stats = []
+		for pdf_file in pdf_files:
+			stat = os.stat(pdf_file)
+			stats.append([stat.st_size, stat.st_mtime])
+		self.entries[os.path.abspath(filename)] = {
+				'hash': digest,
+				'pdfs': pdf_files,
+				'stats': stats}
+
+	def save(self):
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(self.entries, f, indent=1, sort_keys=True)
+		os.replace(tmp_path, self.path)
+
+# The parser's and the renderer's names used to live here, and still work from here:
+# from chord_chart import parse_text, ChartRenderer. chart_renderer, and reportlab
+# with it, is imported the first time one of its names is asked for.
+def __getattr__(name):
+	if name.startswith('__'):
+		raise AttributeError(name)
+	if hasattr(chart_parser, name):
+		return getattr(chart_parser, name)
+	import chart_renderer
+	try:
+		return getattr(chart_renderer, name)
+	except AttributeError:
+		raise AttributeError("module 'chord_chart' has no attribute %r" % name) from None
 
 #######################################################################################
-# print measures 
+#######################################################################################
+# MAIN 
+#######################################################################################
 #######################################################################################
 
-def print_measures(sections):
-	running_count = 0
-	mcount = 0
-
-	for index in sorted(sections):
-		data = sections[index]
-		name = data['name']
-		cols = int(data['width'])
-		meas = data['measures']
-		chords = meas['chords']
 
-		# print section title
-		elements.append(spacers['section'])
-		if name:
-			elements.append(Paragraph(name, styles['section_header_text']))
-			elements.append(spacers['section_title'])
-	
-		# make tables for the measure lines
-		t = create_table(meas, cols, running_count)
+def main(argv):
+	parser = argparse.ArgumentParser(prog='chord_chart.py',
+			description='Create box chord chart PDFs from text chart files.')
+	parser.add_argument('charts', nargs='*', metavar='chart',
+			help="chart .txt file, or a directory of them; '-' reads one chart from stdin and writes the PDF to stdout")
+	parser.add_argument('-j', '--jobs', type=int, default=1,
+			help='number of charts to render in parallel (0 = one per CPU); with --serve, the number of worker processes')
+	parser.add_argument('-f', '--force', action='store_true',
+			help='render every chart, even ones whose PDF is up to date')
+	parser.add_argument('-k', '--keys', type=parse_keys,
+			help="comma-separated keys to render each chart in (or 'all'), one PDF per key")
+	parser.add_argument('--from-key', choices=sorted(SCALE_DEGREES),
+			help="the key charts are written in, for --keys (default: the key the chart's key change line goes to)")
+	parser.add_argument('--engine', choices=ENGINE_NAMES, default='platypus',
+			help='platypus lays the charts out with reportlab tables; canvas lays them out itself and draws them straight onto the page, which is much faster (default %(default)s)')
+	parser.add_argument('--preview', choices=PREVIEW_NAMES,
+			help="write a quick SVG or HTML preview of each chart instead of a PDF, from the canvas engine's layout")
+	parser.add_argument('--fit', choices=FIT_MODE_NAMES, default='cell',
+			help="shrink each chord and lyric to fit its own cell, or fit all the chords and all the lyrics in a measure row, or a section, at one size so they look even (default %(default)s)")
+	parser.add_argument('--fit-pages', type=int, metavar='N',
+			help="render each chart at the biggest scale (up to its own) that fits it on N pages, instead of at the scale it gives")
+	parser.add_argument('--profile', action='store_true',
+			help='render every chart in this process and report where the time went (on stderr)')
+	parser.add_argument('--songbook', metavar='PDF',
+			help='render all the charts into this one PDF, each starting a new page')
+	parser.add_argument('--toc', action='store_true',
+			help='start the --songbook with a table of contents, and number its pages')
+	parser.add_argument('-c', '--check', action='store_true',
+			help="only parse the charts, reporting every error in them with its line number; no PDFs are made")
+	parser.add_argument('-w', '--watch', action='store_true',
+			help='after rendering, keep watching the charts and render each one again as soon as it changes (Ctrl-C to stop)')
+	parser.add_argument('--serve', type=parse_address, metavar='[HOST:]PORT',
+			help="instead of rendering chart files, serve HTTP on this port (on %s unless a host is given): POST a chart to / and get the PDF back" % DEFAULT_HOST)
+	parser.add_argument('--queue', type=int, metavar='N',
+			help='with --serve, how many requests can wait for a worker before more are turned away with 503 (default 4 per worker)')
+	args = parser.parse_args(argv)
+
+	if args.serve:
+		if args.charts or args.songbook or args.keys or args.from_key or args.check or args.watch or args.profile:
+			parser.error('--serve renders the charts posted to it; it takes no charts, and only --jobs, --queue, --engine, --preview, --fit and --fit-pages')
+	elif not args.charts:
+		parser.error('the following arguments are required: chart')
+	if args.queue is not None and not args.serve:
+		parser.error('--queue needs --serve')
+	if args.queue is not None and args.queue < 0:
+		parser.error("--queue can't be negative")
+	if args.jobs < 0:
+		parser.error("--jobs can't be negative (0 is one per CPU)")
+
+	if args.songbook and args.keys:
+		parser.error('--keys and --songbook can not be used together')
+	if args.toc and not args.songbook:
+		parser.error('--toc needs --songbook')
+	if args.fit_pages is not None and args.fit_pages < 1:
+		parser.error('--fit-pages needs at least one page')
+	if args.fit_pages and args.songbook:
+		parser.error('--fit-pages can not be used with --songbook')
+	if args.watch and '-' in args.charts:
+		parser.error("can't --watch stdin")
+	if args.check and '-' in args.charts:
+		parser.error("can't --check stdin")
+	if args.check and (args.songbook or args.keys or args.profile or args.fit != 'cell' or args.fit_pages or args.preview):
+		parser.error('--check only parses; it takes no rendering options')
+	if args.preview:
+		# laid out by the canvas engine, whatever --engine says
+		args.engine = args.preview
+
+	if args.serve:
+		from chart_server import serve
+		serve(args.serve, args.jobs or os.cpu_count(), args.queue, args.engine, args.fit, args.fit_pages)
+		return
+
+	if args.check:
+		# the parser alone: nothing is rendered, and reportlab never gets imported
+		ok = check_all(get_chart_files(args.charts)) == 0
+		if args.watch:
+			def check(changed):
+				check_all(changed)
+				sys.stdout.flush()
+
+			print("watching for changes (Ctrl-C to stop)")
+			sys.stdout.flush()
+			watch_charts(args.charts, check)
+			ok = True
+		if not ok:
+			sys.exit(1)
+		return
+
+	profile = None
+	if args.profile:
+		from chart_renderer import RenderProfile
+		profile = RenderProfile()
+
+	if args.charts == ['-']:
+		render_stdio(profile, args.engine, args.fit, args.fit_pages)
+		if profile is not None:
+			profile.report()
+		return
+
+	jobs = args.jobs or os.cpu_count()
+	filenames = get_chart_files(args.charts)
+	if not os.path.isdir(PDF_DIR):
+		os.makedirs(PDF_DIR)
+
+	if profile is not None:
+		# everything has to be rendered, here, and actually parsed
+		global renderer
+		renderer = renderer_class(args.engine)(profile=profile, fit=args.fit, fit_pages=args.fit_pages)
+		jobs = 1
+		args.force = True
+
+	cache = None if args.force else RenderCache(PDF_DIR)
+	if args.songbook:
+		ok = render_songbook_report(filenames, args.songbook, args.toc, args.engine, args.fit)
+	else:
+		start = time.perf_counter()
+		results = render_all(filenames, jobs, cache, args.keys, args.from_key, args.engine, args.fit, args.fit_pages)
+		wall = time.perf_counter() - start
 
-		running_count += len(chords)
+		if len(filenames) > 1:
+			print_timings(results, wall)
+		else:
+			for result in results:
+				if result.error:
+					print(result.filename + ": " + result.error)
+		ok = not any(result.error for result in results)
+
+	if args.watch:
+		# in this process from here on, with the renderer, its styles and the
+		# fit cache all warmed up by the first change
+		def render(changed):
+			if args.songbook:
+				render_songbook_report(get_chart_files(args.charts), args.songbook, args.toc, args.engine, args.fit)
+			else:
+				for result in render_all(changed, 1, cache, args.keys, args.from_key, args.engine, args.fit, args.fit_pages):
+					print_result(result)
+			sys.stdout.flush()
 
-#######################################################################################
-# finish pdf
-#######################################################################################
-def finish_pdf():
-	doc.build(elements)
+		print("watching for changes (Ctrl-C to stop)")
+		sys.stdout.flush()
+		watch_charts(args.charts, render)
+		ok = True
 
-#######################################################################################
-#######################################################################################
-# MAIN 
-#######################################################################################
-#######################################################################################
+	if profile is not None:
+		profile.report()
 
+	if not ok:
+		sys.exit(1)
 
-if len(sys.argv) != 2:
-	print("Usage: chord_chart.py datafile.txt")
-	exit()
-	
-filename = sys.argv[1]
-
-mdata, sections = parse_file(filename)
-set_scaled_constants()
-create_styles()
-create_spacers()
-start_pdf(mdata)
-print_metadata(mdata)
-print_measures(sections)
-finish_pdf()
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,164 @@
+# Copyright (c) 2016 Bonnie Schulkin. All Rights Reserved.
+#
+# This file is part of box_charts.
+#
+# box_charts is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# box_charts is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+# for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with box_charts. If not, see <http://www.gnu.org/licenses/>.
+
+
+#######################################################################################
+# parsing and transposing charts, and a renderer's styles not growing with them
+#
+# Run with: python -m pytest test_chord_chart.py
+#######################################################################################
+
+import os
+from io import BytesIO
+
+import pytest
+
+import chord_chart
+import chart_parser
+import chart_renderer
+from chart_parser import ChartError
+
+SAMPLE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'sample_input.txt')
+
+#######################################################################################
+# parsing
+#######################################################################################
+
+def parse_error(text):
+	# (line, message) of the ChartError parsing the text raises
+	with pytest.raises(ChartError) as e:
+		chart_parser.parse_text(text)
+	return (e.value.line, str(e.value))
+
+def test_parses_sample():
+	chart = chart_parser.parse_file(SAMPLE)
+	assert chart.title == 'Does My Ring Burn Your Finger'
+	for section in chart.sections:
+		assert section.width > 0
+		assert all(section.chords)
+		assert all(len(lyrics) <= len(section.chords) for lyrics in section.lyrics)
+
+@pytest.mark.parametrize('text, error', [
+	('^T\n+A~lyrics=1\n\nG|C\nla|la\n', (2, 'section [A] has no width=')),
+	('^T\n+A~width=2\n\nG|C\nla|la\n', (2, 'section [A] has no lyrics=')),
+	('^T\n+A~width=0~lyrics=1\n\nG|C\nla|la\n', (2, 'Bad section data: [width=0]')),
+	('^T\n+A~width=2~lyrics=-1\n\nG|C\nla|la\n', (2, 'Bad section data: [lyrics=-1]')),
+	('^T\n+A~width=2~lyrics=1~pickup=-1\n\nG|C\nla|la\n', (2, 'Bad section data: [pickup=-1]')),
+	('^T\n+A~width=2~lyrics=1\n\nG||C\nla|la|la\n', (4, 'empty measure in [G||C]')),
+	('^T\n\nG|C\nla|la\n', (3, 'measures before the first section line: [G|C]')),
+	('^T\n*scale=0\n', (2, 'Bad scale line [*scale=0]')),
+	('^T\n*scale=-1\n', (2, 'Bad scale line [*scale=-1]')),
+	('^T\n*scale=nan\n', (2, 'Bad scale line [*scale=nan]')),
+	('^T\n*scale=1e308\n', (2, 'Bad scale line [*scale=1e308]')),
+])
+def test_parse_errors(text, error):
+	assert parse_error(text) == error
+
+def test_parse_collects_every_error():
+	text = '^T\nG|C\n*scale=0\n\n+A~width=2~lyrics=1\n\nG||C\nla|la|la\n\n+B~lyrics=1\n\nG|C\nla|la\n'
+	errors = []
+	chart_parser.parse_lines(text.split('\n'), errors)
+	assert [(e.line, str(e)) for e in errors] == [
+		(2, 'bad line: [G|C]'),
+		(3, 'Bad scale line [*scale=0]'),
+		(7, 'empty measure in [G||C]'),
+		(10, 'section [B] has no width='),
+	]
+
+#######################################################################################
+# transposing
+#######################################################################################
+
+@pytest.mark.parametrize('chord, transposed', [
+	('C', 'Db'), # a natural off the scale keeps its accidental
+	('C#m7', 'Dm7'),
+	('%', '%'),
+	('%:', '%:'), # an end repeat on a repeated measure isn't a chord
+	(':C#m7:', ':Dm7:'),
+	('', ''),
+])
+def test_transpose(chord, transposed):
+	assert chart_parser.transpose('A', 'Bb', chord) == transposed
+
+def test_transpose_list():
+	assert chart_parser.transpose_list('C', 'D', ['G/B', 'C F', 'Am7']) == ['A/C#', 'D G', 'Bm7']
+	assert chart_parser.transpose_list('', 'D', ['G/B']) == ['G/B']
+
+def test_transpose_errors():
+	with pytest.raises(ChartError):
+		chart_parser.transpose('A', 'H', 'C')
+	with pytest.raises(ChartError):
+		chart_parser.transpose('A', 'Bb', 'Q')
+
+def test_transpose_round_trip():
+	chords = ['C', 'Dm7', 'Em', 'F', 'G7', 'Am', 'Bdim', 'E7', 'Bb', 'F#m']
+	for key in chart_parser.SCALE_DEGREES:
+		there = chart_parser.transpose_list('C', key, chords)
+		assert chart_parser.transpose_list(key, 'C', there) == chords
+
+def test_key_change_line():
+	chart = chart_parser.parse_text('^T\n}A~Bb\n+A~width=2~lyrics=1\n\nC|%:\nla|la\n')
+	assert chart.key == 'Bb'
+	assert chart.sections[0].chords == ['Db', '%:']
+
+	transposed = chart_parser.transpose_chart(chart, 'Bb', 'C')
+	assert transposed.key == 'C'
+	assert transposed.sections[0].chords == ['Eb', '%:']
+	assert chart.sections[0].chords == ['Db', '%:']
+
+#######################################################################################
+# styles
+#######################################################################################
+
+def style_counts(renderer):
+	return (len(renderer.styles.byName), len(renderer.style_pool))
+
+@pytest.mark.parametrize('engine', chord_chart.ENGINE_NAMES)
+def test_styles_bounded_across_renders(engine):
+	text = chord_chart.read_chart(SAMPLE)
+	renderer = chord_chart.renderer_class(engine)()
+
+	renderer.render(text)
+	counts = style_counts(renderer)
+	for n in range(10):
+		renderer.render(text)
+	assert style_counts(renderer) == counts
+
+@pytest.mark.parametrize('engine', chord_chart.ENGINE_NAMES)
+def test_styles_bounded_across_songbook(engine):
+	chart = chord_chart.parse_file(SAMPLE)
+
+	counts = []
+	for n in (1, 10):
+		renderer = chord_chart.renderer_class(engine)()
+		errors = renderer.render_songbook([chart] * n, BytesIO())
+		assert not errors
+		counts.append(style_counts(renderer))
+	assert counts[0] == counts[1]
+
+@pytest.mark.parametrize('engine', chord_chart.ENGINE_NAMES)
+def test_styles_bounded_across_scales(engine):
+	# only the last few scales' styles are kept
+	text = chord_chart.read_chart(SAMPLE)
+	renderer = chord_chart.renderer_class(engine)()
+
+	renderer.render(text)
+	stylesheet = style_counts(renderer)[0]
+	for n in range(3 * chart_renderer.SCALED_CACHE_SIZE):
+		renderer.render('*scale=%g\n' % (0.5 + n / 100.0) + text)
+		assert style_counts(renderer)[0] == stylesheet
+	assert len(renderer.scaled) == chart_renderer.SCALED_CACHE_SIZE